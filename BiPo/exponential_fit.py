@@ -5,9 +5,8 @@ for the BiPo experiment.
 
 from scipy.optimize import curve_fit
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.rcParams.update({'font.size': 22})
+
+import plotting
 
 FIT_POINTS = [
     # (delay in nanoseconds, time in seconds, counts)
@@ -26,12 +25,12 @@ GUESSES = (1, 4, 2e-3)  # based on the trendline from the spreadsheet
 
 
 def fit_func(delay_time, constant_offset, y_scale, lambda_):
-    """the function we want to fit"""
+    """Return the function we want to fit."""
     return constant_offset+y_scale*np.exp(-delay_time*lambda_)
 
 
 def main():
-    """make a fit, calculate half-life, make a plot"""
+    """Make a fit, calculate half-life, make a plot."""
     delays, times, counts = map(np.array, list(zip(*FIT_POINTS)))
     counts_per_sec = counts / times
     err_in_cps = np.sqrt(counts) / times
@@ -42,15 +41,6 @@ def main():
 
     half_life = np.log(2)/lambda_
 
-    # plot data with error bars
-    plt.figure(figsize=(8, 8))
-    plt.scatter(delays, counts_per_sec)
-    plt.errorbar(
-        delays, counts_per_sec,
-        # xerr=calc_act_uncerts,
-        yerr=err_in_cps,
-        fmt='o', ecolor='k', color='k')
-
     fit_line_delays = np.arange(min(delays), max(delays), 1)
     fit_line_cps = fit_func(fit_line_delays, *fit_params)
     fit_param_error = np.sqrt(np.diag(fit_covariances))
@@ -61,12 +51,30 @@ def main():
     half_life_high = np.log(2)/(lambda_ - decay_err)
     print(f"Calculated half life {half_life:.2f} ns")
     print(f"±1σ half-life band: [{half_life_low}, {half_life_high}]")
+    plotting.plot(plot_fit, delays, counts_per_sec, err_in_cps,
+                  fit_line_delays, fit_line_cps)
+
+
+def plot_fit(delays, counts_per_sec, err_in_cps, fit_line_delays,
+             fit_line_cps):
+    """Plot data with error bars and the fit, save as BiPo.png."""
+    plt = plotting.pyplot()
+    plt.rcParams.update({'font.size': 22})
+    plt.figure(figsize=(8, 8))
+    plt.scatter(delays, counts_per_sec)
+    plt.errorbar(
+        delays, counts_per_sec,
+        # xerr=calc_act_uncerts,
+        yerr=err_in_cps,
+        fmt='o', ecolor='k', color='k')
     plt.xlabel("Delay [ns]")
     plt.ylabel("Counts per second")
     plt.plot(fit_line_delays, fit_line_cps, 'g')
     plt.tight_layout()
     plt.savefig("BiPo.png")
+    plt.close()
 
 
 if __name__ == "__main__":
     main()
+    plotting.render_pending()
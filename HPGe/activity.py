@@ -1,15 +1,18 @@
-"""A module for dealing with activity calculations."""
+"""
+A module for dealing with activity calculations.
+
+The activities of the calibration sources (and the line fit to them) are
+only calculated when they're first used, not on import.
+"""
+from functools import lru_cache
 from inspect import cleandoc
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
 import numpy as np
 
 from read_spe import data, Spectrum
 from energy_calibration import channel_from_energy, energy_from_channel
 from peak_data import known_peaks, Source
 import peaks
-
-plt.rcParams.update({'font.size': 22})
+import plotting
 
 
 def activity(spec: Spectrum, peak_channel, tol, plot=True):
@@ -24,22 +27,28 @@ def activity(spec: Spectrum, peak_channel, tol, plot=True):
     uncertainty = np.sqrt(bkg_sum)  # number of counts
 
     if plot:
-        plt.figure(figsize=(10, 10))
-        plt.plot(data.bkg.spectrum/data.bkg.live_time, label=data.bkg.label)
-        plt.plot(spec.spectrum/spec.live_time, label=spec.label)
-        plt.ylim(0, 1.1*spec.spectrum[peak_channel]/spec.live_time)
-        plt.xlim(start, stop)
-        plt.legend(fontsize=30)
-        output_filename = spec.filename.replace(
-            ".Spe", f"_peak_{peak_channel}.pdf")
-        output_filename = output_filename.replace(
-            "data", "images")
-        plt.savefig(output_filename)
-        plt.cla()
-        plt.clf()
+        plotting.plot(plot_activity, spec, peak_channel, start, stop)
     return peak_activity, uncertainty
 
 
+def plot_activity(spec: Spectrum, peak_channel, start, stop):
+    """Plot spec and the background around a peak (see activity)."""
+    plt = plotting.pyplot()
+    plt.rcParams.update({'font.size': 22})
+    plt.figure(figsize=(10, 10))
+    plt.plot(data.bkg.spectrum/data.bkg.live_time, label=data.bkg.label)
+    plt.plot(spec.spectrum/spec.live_time, label=spec.label)
+    plt.ylim(0, 1.1*spec.spectrum[peak_channel]/spec.live_time)
+    plt.xlim(start, stop)
+    plt.legend(fontsize=30)
+    output_filename = spec.filename.replace(
+        ".Spe", f"_peak_{peak_channel}.pdf")
+    output_filename = output_filename.replace(
+        "data", "images")
+    plt.savefig(output_filename)
+    plt.close()
+
+
 class PeakActivities():
     """Class for storing activities at peaks for a given source/spectrum."""
 
@@ -60,11 +69,6 @@ class PeakActivities():
         self.activities_per_g = None if grams is None else activities/grams
 
 
-Co60 = PeakActivities(known_peaks.Co60, data.Co60)
-Ba133 = PeakActivities(known_peaks.Ba133, data.Ba133)
-Na22 = PeakActivities(known_peaks.Na22, data.Na22)
-
-
 def current_activity(A0, time, half_life):
     '''
     Returns current activity in Bq
@@ -76,6 +80,35 @@ def current_activity(A0, time, half_life):
     return A0*np.exp(-(time*np.log(2))/half_life)
 
 
+def plot_activity_calibration(calc_activities, real_activities,
+                              calc_act_uncerts, y_error, activity_x_values,
+                              fit_activities):
+    """Plot real vs calculated activities and the line fit to them."""
+    import matplotlib.patches as mpatches
+    plt = plotting.pyplot()
+    plt.rcParams.update({'font.size': 22})
+    plt.figure(figsize=(15, 15))
+    plt.xlabel("Measured Sum of Bin Counts")
+    plt.ylabel("Activity [Bq]")
+    plt.errorbar(
+        calc_activities, real_activities,
+        xerr=calc_act_uncerts, yerr=y_error,
+        fmt='o', ecolor='k', color='k')
+
+    co_patch = mpatches.Patch(color='g', label=data.Co60.label)
+    ba_patch = mpatches.Patch(color='b', label=data.Ba133.label)
+    na_patch = mpatches.Patch(color='r', label=data.Na22.label)
+    colors = ['g']*2 + ['b']*5 + ['r']*1
+    plt.plot(activity_x_values, fit_activities)
+    plt.scatter(calc_activities, real_activities, s=100,
+                c=colors, marker="o", zorder=100, linewidths=5)
+
+    plt.legend(handles=[co_patch, ba_patch, na_patch])
+
+    plt.savefig("images/activity_calibration.pdf")
+    plt.close()
+
+
 na22_current_act = current_activity(37e3, 762, 2.6018*365)
 co60_current_act = current_activity(3.7e5, 16390, 1925.28)
 ba133_current_act = current_activity(3.81e5, 6925, 10.551*365)
@@ -91,50 +124,78 @@ real_ba133_acts = list(
 real_co60_acts = list(
     co60_current_act * np.array(known_peaks.Co60.intensities))
 
-calc_na22_acts = list(Na22.calc_peak_activities)
-calc_ba133_acts = list(Ba133.calc_peak_activities)
-calc_co60_acts = list(Co60.calc_peak_activities)
-
-na22_act_uncert = list(Na22.uncertainties)
-ba133_act_uncert = list(Ba133.uncertainties)
-co60_act_uncert = list(Co60.uncertainties)
-
 real_activities = real_co60_acts + real_ba133_acts + real_na22_acts
-calc_activities = calc_co60_acts + calc_ba133_acts + calc_na22_acts
-calc_act_uncerts = co60_act_uncert + ba133_act_uncert + na22_act_uncert
-
-# need real = line(calculated)
-act_line = np.polyfit(calc_activities, real_activities, deg=1)
-activity_x_values = np.arange(min(calc_activities), max(calc_activities), 1)
-fit_activities = np.polyval(act_line, activity_x_values)
-
 y_error = [real_co60_uncert]*2 + [real_ba133_uncert]*5 + [real_na22_uncert]*1
 
-plt.figure(figsize=(15, 15))
-plt.xlabel("Measured Sum of Bin Counts")
-plt.ylabel("Activity [Bq]")
-plt.errorbar(
-    calc_activities, real_activities,
-    xerr=calc_act_uncerts, yerr=y_error,
-    fmt='o', ecolor='k', color='k')
-
-co_patch = mpatches.Patch(color='g', label=data.Co60.label)
-ba_patch = mpatches.Patch(color='b', label=data.Ba133.label)
-na_patch = mpatches.Patch(color='r', label=data.Na22.label)
-colors = ['g']*2 + ['b']*5 + ['r']*1
-plt.plot(activity_x_values, fit_activities)
-plt.scatter(calc_activities, real_activities, s=100,
-            c=colors, marker="o", zorder=100, linewidths=5)
-
-plt.legend(handles=[co_patch, ba_patch, na_patch])
-
-plt.savefig("images/activity_calibration.pdf")
-plt.cla()
-plt.clf()
 
-Na22.real_peak_activities = np.polyval(act_line, Na22.calc_peak_activities)
-Ba133.real_peak_activities = np.polyval(act_line, Ba133.calc_peak_activities)
-Co60.real_peak_activities = np.polyval(act_line, Co60.calc_peak_activities)
+@lru_cache(maxsize=None)
+def activity_calibration():
+    """
+    Calculate the calibration source activities, the first time it's called.
+
+    Returns a dict with the PeakActivities of each source, the calculated
+    activities and the line fit to them (the names in CALIBRATION_NAMES),
+    each can also be used as activity.<name>.
+    """
+    Co60 = PeakActivities(known_peaks.Co60, data.Co60)
+    Ba133 = PeakActivities(known_peaks.Ba133, data.Ba133)
+    Na22 = PeakActivities(known_peaks.Na22, data.Na22)
+
+    calc_na22_acts = list(Na22.calc_peak_activities)
+    calc_ba133_acts = list(Ba133.calc_peak_activities)
+    calc_co60_acts = list(Co60.calc_peak_activities)
+
+    na22_act_uncert = list(Na22.uncertainties)
+    ba133_act_uncert = list(Ba133.uncertainties)
+    co60_act_uncert = list(Co60.uncertainties)
+
+    calc_activities = calc_co60_acts + calc_ba133_acts + calc_na22_acts
+    calc_act_uncerts = co60_act_uncert + ba133_act_uncert + na22_act_uncert
+
+    # need real = line(calculated)
+    act_line = np.polyfit(calc_activities, real_activities, deg=1)
+    activity_x_values = np.arange(
+        min(calc_activities), max(calc_activities), 1)
+    fit_activities = np.polyval(act_line, activity_x_values)
+
+    plotting.plot(plot_activity_calibration, calc_activities,
+                  real_activities, calc_act_uncerts, y_error,
+                  activity_x_values, fit_activities)
+
+    for sample in (Na22, Ba133, Co60):
+        sample.real_peak_activities = np.polyval(
+            act_line, sample.calc_peak_activities)
+    return {
+        "Co60": Co60,
+        "Ba133": Ba133,
+        "Na22": Na22,
+        "calc_na22_acts": calc_na22_acts,
+        "calc_ba133_acts": calc_ba133_acts,
+        "calc_co60_acts": calc_co60_acts,
+        "na22_act_uncert": na22_act_uncert,
+        "ba133_act_uncert": ba133_act_uncert,
+        "co60_act_uncert": co60_act_uncert,
+        "calc_activities": calc_activities,
+        "calc_act_uncerts": calc_act_uncerts,
+        "act_line": act_line,
+        "activity_x_values": activity_x_values,
+        "fit_activities": fit_activities,
+    }
+
+
+CALIBRATION_NAMES = [
+    "Co60", "Ba133", "Na22",
+    "calc_na22_acts", "calc_ba133_acts", "calc_co60_acts",
+    "na22_act_uncert", "ba133_act_uncert", "co60_act_uncert",
+    "calc_activities", "calc_act_uncerts",
+    "act_line", "activity_x_values", "fit_activities"]
+
+
+def __getattr__(name):
+    """Return activity_calibration()[name] for names that used to be here."""
+    if name in CALIBRATION_NAMES:
+        return activity_calibration()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == "__main__":
@@ -144,11 +205,13 @@ if __name__ == "__main__":
     x_peak_stdev = x_peak_stdevs[0]
     x_peak_energies = [energy_from_channel(x_peak_channel)]
 
+    calibration = activity_calibration()
     x_activities = PeakActivities(Source(x_peak_energies), data.x)
     x_activities.real_peak_activities = np.polyval(
-        act_line, x_activities.calc_peak_activities)
+        calibration["act_line"], x_activities.calc_peak_activities)
 
-    samples = [Co60, Ba133, Na22, x_activities]
+    samples = [calibration["Co60"], calibration["Ba133"], calibration["Na22"],
+               x_activities]
 
     peak_stdevs = [
         peaks.co_peak_stdevs,
@@ -167,3 +230,4 @@ if __name__ == "__main__":
                 Activity uncertainties [sqrt(n)]= {
                     [round(s, 2) for s in sample.uncertainties]}
             """))
+    plotting.render_pending()
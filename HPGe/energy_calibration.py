@@ -1,43 +1,334 @@
-"""Module for getting a relationship between channels and energies."""
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
+"""
+Module for getting a relationship between channels and energies.
+
+A Calibration is a least squares fit of energy = sum of coefficients *
+basis functions of the channel:
+- "poly": channel**degree, ..., channel, 1 (coefficients in np.polyfit
+  order, so the default degree 1 is [slope, intercept])
+- "sqrt": the same plus sqrt(channel), for detectors that aren't linear
+Only the sums in the normal equations are kept, so new calibration peaks
+can be added with add_points without the old ones. It can be saved to
+(and loaded from) a small JSON file with the coefficients, covariance
+and those sums.
+
+The default calibration is loaded from CALIBRATION_FILE (next to this
+module) if it exists (python energy_calibration.py makes it), otherwise
+it's fitted to the peaks from peaks.py when it's first used, so
+importing this is quick. The file keeps a hash of what it was fitted
+from (the calibration spectra and the peak finding code, see
+calibration_source), and it's only used if that still matches, so an
+old file is refitted (with a warning) instead of silently used.
+"""
+from argparse import ArgumentParser
+from functools import lru_cache
+import hashlib
+import json
+import os
+import warnings
 import numpy as np
 
-from read_spe import data, CHANNELS
-from peaks import peaks, peak_stdevs
+from read_spe import data, CHANNELS, N_CHANNELS
+import plotting
+
+# next to this file, so it's the same file whichever directory we're run from
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "energy_calibration.json")
+CALIBRATION_VERSION = 1  # files with a different version can't be loaded
+MODELS = ("poly", "sqrt")
+# what fit_calibration uses: the spectra (aliases in read_spe.data) and
+# the files with the peak finding code and known energies
+SOURCE_SPECTRA = ("Co60", "Ba133", "Na22")
+SOURCE_CODE = ("peaks.py", "peak_data.py")
+
+
+class Calibration():
+    """
+    Class for an energy calibration that can be updated and saved.
+
+    Example:
+        calibration = Calibration.from_points(channels, energies)
+        calibration.add_points([5501.9], [1274.5])  # a new peak
+        calibration.energy(CHANNELS), calibration.energy_error(CHANNELS)
+        calibration.channel(1460.8)
+        calibration.save("energy_calibration.json")
+        calibration = Calibration.load("energy_calibration.json")
+    """
+
+    def __init__(self, model="poly", degree=1):
+        """Make an empty calibration, see the module docstring for models."""
+        if model not in MODELS:
+            raise ValueError(f"model must be one of {MODELS}, not {model!r}")
+        self.model = model
+        self.degree = degree
+        n_params = degree + 1 + (model == "sqrt")
+        # sums for the normal equations, A^T W A, A^T W E, E^T W E
+        self.ata = np.zeros((n_params, n_params))
+        self.ate = np.zeros(n_params)
+        self.ete = 0.0
+        self.n_points = 0
+        self.weighted = None  # True if points were added with errors
+        self.source = ""  # calibration_source() if from fit_calibration
+
+    def basis(self, channels):
+        """Return the basis functions of channels, a (channels x params)."""
+        channels = np.asarray(channels, dtype=float)
+        columns = [channels**power for power in range(self.degree, 0, -1)]
+        if self.model == "sqrt":
+            columns.append(np.sqrt(channels))
+        columns.append(np.ones_like(channels))
+        return np.stack(columns, axis=-1)
+
+    def basis_derivative(self, channels):
+        """Return d(basis)/d(channel), like basis."""
+        channels = np.asarray(channels, dtype=float)
+        columns = [power*channels**(power - 1)
+                   for power in range(self.degree, 0, -1)]
+        if self.model == "sqrt":
+            columns.append(0.5 / np.sqrt(channels))
+        columns.append(np.zeros_like(channels))
+        return np.stack(columns, axis=-1)
+
+    def add_points(self, channels, energies, energy_errors=None):
+        """
+        Add calibration peaks (channels and their known energies, keV).
+
+        energy_errors: errors on the energies, used as weights. Without
+                       them, the covariance is scaled by the scatter of
+                       the points. Use errors for all points or none.
+        """
+        basis = self.basis(np.ravel(channels))
+        energies = np.asarray(energies, dtype=float).ravel()
+        weighted = energy_errors is not None
+        if self.weighted is not None and weighted != self.weighted:
+            raise ValueError("add energy_errors for all points or for none")
+        self.weighted = weighted
+        weights = (1 / np.asarray(energy_errors, dtype=float).ravel()**2
+                   if weighted else np.ones_like(energies))
+        self.ata += basis.T @ (basis * weights[:, None])
+        self.ate += basis.T @ (energies * weights)
+        self.ete += float(np.sum(energies**2 * weights))
+        self.n_points += len(energies)
+
+    def _scaled_inverse(self):
+        """Return inverse(A^T W A), with the columns scaled first."""
+        if self.n_points < len(self.ate):
+            raise ValueError(f"need at least {len(self.ate)} points for a "
+                             f"{self.model} {self.degree} calibration, "
+                             f"got {self.n_points}")
+        # channel**degree >> 1, so scale to keep the inverse accurate
+        scale = 1 / np.sqrt(np.diag(self.ata))
+        return scale[:, None] * np.linalg.inv(
+            self.ata * np.outer(scale, scale)) * scale
+
+    @property
+    def coefficients(self):
+        """Return the fit coefficients, in basis order."""
+        return self._scaled_inverse() @ self.ate
+
+    @property
+    def chi2(self):
+        """Return the (weighted) sum of squared residuals of the fit."""
+        return max(self.ete - self.coefficients @ self.ate, 0.0)
+
+    @property
+    def covariance(self):
+        """Return the covariance of the coefficients."""
+        covariance = self._scaled_inverse()
+        if self.weighted:
+            return covariance
+        n_free = self.n_points - len(self.ate)
+        return covariance * (self.chi2 / n_free if n_free > 0 else np.inf)
+
+    def energy(self, channels):
+        """Return the energy [keV] of channels (can be an array)."""
+        return self.basis(channels) @ self.coefficients
+
+    def energy_error(self, channels):
+        """Return the error on energy(channels), from the covariance."""
+        basis = self.basis(channels)
+        return np.sqrt(np.einsum("...i,ij,...j->...", basis,
+                                 self.covariance, basis))
+
+    def channel(self, energies, tolerance=1e-9, max_iterations=50):
+        """
+        Return the channel of energies [keV] (may not be an integer!).
+
+        Exact for the linear model, otherwise found with Newton's method
+        starting from a straight line through the calibration.
+        """
+        coefficients = self.coefficients
+        energies = np.asarray(energies, dtype=float)
+        if self.model == "poly" and self.degree == 1:
+            return (energies - coefficients[1]) / coefficients[0]
+        # start from the line between the ends of the 8k channel range
+        ends = np.array([1.0, N_CHANNELS - 1])
+        slope, intercept = np.polyfit(ends, self.energy(ends), 1)
+        channels = (energies - intercept) / slope
+        for _ in range(max_iterations):
+            step = ((self.energy(channels) - energies)
+                    / (self.basis_derivative(channels) @ coefficients))
+            channels = np.maximum(channels - step, 0)
+            if np.all(np.abs(step) < tolerance):
+                break
+        return channels
+
+    def to_dict(self):
+        """Return the calibration as a dict (for JSON)."""
+        return {
+            "version": CALIBRATION_VERSION,
+            "model": self.model,
+            "degree": self.degree,
+            "coefficients": self.coefficients.tolist(),
+            "covariance": self.covariance.tolist(),
+            "n_points": self.n_points,
+            "weighted": self.weighted,
+            "ata": self.ata.tolist(),
+            "ate": self.ate.tolist(),
+            "ete": self.ete,
+            "source": self.source,
+        }
+
+    @classmethod
+    def from_dict(cls, calibration_dict):
+        """Return a Calibration from to_dict."""
+        if calibration_dict.get("version") != CALIBRATION_VERSION:
+            raise ValueError(
+                f"calibration version {calibration_dict.get('version')}, "
+                f"this code reads version {CALIBRATION_VERSION}")
+        calibration = cls(calibration_dict["model"],
+                          calibration_dict["degree"])
+        calibration.ata = np.array(calibration_dict["ata"], dtype=float)
+        calibration.ate = np.array(calibration_dict["ate"], dtype=float)
+        calibration.ete = calibration_dict["ete"]
+        calibration.n_points = calibration_dict["n_points"]
+        calibration.weighted = calibration_dict["weighted"]
+        calibration.source = calibration_dict.get("source", "")
+        return calibration
+
+    def save(self, filename=CALIBRATION_FILE):
+        """Save the calibration to a JSON file."""
+        with open(filename, "w", encoding="utf-8") as calibration_file:
+            json.dump(self.to_dict(), calibration_file, indent=1)
+
+    @classmethod
+    def load(cls, filename=CALIBRATION_FILE):
+        """Return the Calibration saved in a JSON file."""
+        with open(filename, "r", encoding="utf-8") as calibration_file:
+            return cls.from_dict(json.load(calibration_file))
+
+    @classmethod
+    def from_points(cls, channels, energies, model="poly", degree=1,
+                    energy_errors=None):
+        """Return a Calibration fit to some points, see add_points."""
+        calibration = cls(model, degree)
+        calibration.add_points(channels, energies, energy_errors)
+        return calibration
+
+
+def calibration_source():
+    """
+    Return a hash of what fit_calibration uses (spectra and code).
+
+    Reading and hashing the files is much quicker than fitting the peaks.
+    """
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    paths = [os.path.join(data.directory, data.aliases[alias][0])
+             for alias in SOURCE_SPECTRA]
+    paths += [os.path.join(module_dir, name) for name in SOURCE_CODE]
+    source_hash = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as source_file:
+            source_hash.update(source_file.read())
+    return source_hash.hexdigest()
+
+
+def fit_calibration(model="poly", degree=1):
+    """Return a Calibration fit to the calibration peaks from peaks.py."""
+    import peaks  # the peak fits need scipy, so only import it here
+    channels, energies = zip(*peaks.calibration_peaks()["peaks"])
+    calibration = Calibration.from_points(channels, energies, model, degree)
+    calibration.source = calibration_source()
+    return calibration
+
+
+@lru_cache(maxsize=None)
+def default_calibration():
+    """
+    Return the Calibration used by energy_from_channel etc.
+
+    Loaded from CALIBRATION_FILE if there is one and it was fitted from
+    the current calibration spectra and code, otherwise a line fit to the
+    calibration peaks (the first time it's used). A warning says when the
+    file isn't used, or when it isn't a line.
+    """
+    if not os.path.exists(CALIBRATION_FILE):
+        return fit_calibration()
+    calibration = Calibration.load(CALIBRATION_FILE)
+    if calibration.source != calibration_source():
+        warnings.warn(
+            f"{CALIBRATION_FILE} was fitted from other spectra or peak "
+            "code, refitting (run energy_calibration.py to update it)")
+        return fit_calibration()
+    if calibration.model != "poly" or calibration.degree != 1:
+        warnings.warn(
+            f"using the {calibration.model} degree {calibration.degree} "
+            f"calibration from {CALIBRATION_FILE}, not a line")
+    return calibration
 
-plt.rcParams.update({'font.size': 22})
 
-line = np.polyfit(*list(zip(*peaks)), deg=1)
-energies = np.polyval(line, CHANNELS)
+def calibration_line():
+    """
+    Return the default calibration's [slope, intercept].
+
+    Raises ValueError if the default calibration isn't a line (e.g. one
+    saved with --model sqrt or --degree 2), use default_calibration().
+    """
+    calibration = default_calibration()
+    if calibration.model != "poly" or calibration.degree != 1:
+        raise ValueError(
+            f"the default calibration is {calibration.model} degree "
+            f"{calibration.degree}, not a line, see default_calibration()")
+    return calibration.coefficients
 
 
-def energy_from_channel(channel):
+def __getattr__(name):
+    """Return line and energies, which used to be made on import."""
+    if name == "line":
+        return calibration_line()
+    if name == "energies":
+        return default_calibration().energy(CHANNELS)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def energy_from_channel(channel, calibration=None):
     """Given a channel number, return the fit energy."""
-    return line[0]*channel + line[1]
+    if calibration is None:
+        calibration = default_calibration()
+    return calibration.energy(channel)
 
 
-def channel_from_energy(energy):
+def channel_from_energy(energy, calibration=None):
     """
     Given an energy, return the corresponding channel number.
 
     (result may not be an integer!)
     """
-    return (energy - line[1]) / line[0]
+    if calibration is None:
+        calibration = default_calibration()
+    return calibration.channel(energy)
 
 
-if __name__ == "__main__":
-    # make a scatterplot
-
-    peak_channels, peak_energies = list(zip(*peaks))
-
+def plot_calibration(peak_channels, peak_energies, x_error,
+                     calibration=None):
+    """Plot the calibration line, save as images/energy_calibration.pdf."""
+    import matplotlib.patches as mpatches
+    plt = plotting.pyplot()
+    plt.rcParams.update({'font.size': 22})
     plt.figure(figsize=(15, 15))
     plt.xlabel("Measured Channel [Mean of Gaussian Fit]")
     plt.ylabel("Known Energy [keV]")
 
     y_error = np.zeros_like(peak_channels)
-    x_error = peak_stdevs
-    print(x_error)
 
     plt.errorbar(
         peak_channels, peak_energies,
@@ -48,15 +339,39 @@ if __name__ == "__main__":
     ba_patch = mpatches.Patch(color='b', label=data.Ba133.label)
     na_patch = mpatches.Patch(color='r', label=data.Na22.label)
     colors = ['g']*2 + ['b']*5 + ['r']*1
-    plt.plot(CHANNELS, energies)
+    if calibration is None:
+        calibration = default_calibration()
+    plt.plot(CHANNELS, calibration.energy(CHANNELS))
     plt.scatter(peak_channels, peak_energies, s=10,
                 c=colors, marker="o", zorder=100, linewidths=5)
 
     plt.legend(handles=[co_patch, ba_patch, na_patch])
 
     plt.savefig("images/energy_calibration.pdf")
-    plt.cla()
-    plt.clf()
+    plt.close()
+
+
+if __name__ == "__main__":
+    import peaks
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--model", choices=MODELS, default="poly",
+        help="poly, or sqrt (poly + sqrt(channel))")
+    parser.add_argument(
+        "--degree", type=int, default=1, help="degree of the polynomial")
+    parser.add_argument(
+        "-o", dest="output", default=CALIBRATION_FILE,
+        help="file to save the calibration to")
+    args = parser.parse_args()
+    new_calibration = fit_calibration(args.model, args.degree)
+    new_calibration.save(args.output)
+
+    # make a scatterplot
+    x_error = peaks.peak_stdevs
+    print(x_error)
+    plotting.plot(plot_calibration, *zip(*peaks.peaks), x_error,
+                  new_calibration)
 
     # calculate channel from energy for an example energy
-    print(channel_from_energy(1274.5))
+    print(channel_from_energy(1274.5, new_calibration))
+    plotting.render_pending()
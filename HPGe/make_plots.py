@@ -1,33 +1,32 @@
 """Module for storing plotting functions."""
-import matplotlib.pyplot as plt
-
-from read_spe import Spectrum, CHANNELS, data
+from read_spe import Spectrum, data
+import plotting
 
 
 def make_normalized_plot(spectra, labels):
     """Make a normalized plot of all given spectra, using labels for legend."""
+    plt = plotting.pyplot()
     for spec, lab in zip(spectra, labels):
         plt.plot(spec/max(spec), label=lab)
     plt.legend()
     plt.savefig("images/all_spectra_normalized.pdf")
-    plt.cla()
-    plt.clf()
+    plt.close()
 
 
 def plot_spectrum(spec: Spectrum, save=True):
     """Given a spe filename, make a plot -- either save or return the data."""
+    plt = plotting.pyplot()
     plot_data = spec.spectrum
     output_filename = spec.filename.replace(".Spe", ".pdf")
     output_filename = output_filename.replace("data", "images")
     xlabel = spec.filename+" channel number"
     plt.ylabel("counts")
-    plt.plot(CHANNELS, plot_data)
+    plt.plot(spec.channels, plot_data)
     plt.xlabel(xlabel)
 
     if save:
         plt.savefig(output_filename)
-        plt.cla()
-        plt.clf()
+        plt.close()
     else:
         return plot_data
 
@@ -45,10 +44,11 @@ if __name__ == "__main__":
         data.Na22.label,
         data.x.label,
         data.bkg.label]
-    make_normalized_plot(specs, labs)
-
-    plot_spectrum(data.Co60)
-    plot_spectrum(data.Ba133)
-    plot_spectrum(data.Na22)
-    plot_spectrum(data.x)
-    plot_spectrum(data.bkg)
+    plotting.plot(make_normalized_plot, specs, labs)
+
+    plotting.plot(plot_spectrum, data.Co60)
+    plotting.plot(plot_spectrum, data.Ba133)
+    plotting.plot(plot_spectrum, data.Na22)
+    plotting.plot(plot_spectrum, data.x)
+    plotting.plot(plot_spectrum, data.bkg)
+    plotting.render_pending()
@@ -0,0 +1,175 @@
+"""
+Module for fitting the peaks of many spectra in one go.
+
+Each spectrum is fitted with peaks.fit_peaks (with its own settings) in a
+pool of processes, and the results go in one numpy structured array with
+a row per peak, e.g. to compare the bandpass scan runs:
+
+    python peak_batch.py "run*_co60_bandpass*" -n 2 --background-width 100
+
+    table = batch_fit([catalog[name] for name in names],
+                      settings={"n_peaks": 2, "background_width": 100})
+    table[table["status"] == "ok"]["centroid"]
+
+Spectra that can't be fitted get one row with peak = -1, nan values and
+the reason in status, instead of stopping the whole batch.
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import fnmatch
+import numpy as np
+
+from read_spe import DATA_DIR, Spectrum, SpectrumCatalog
+import peaks
+
+# one row per fitted peak, errors are from the fit covariance
+PEAK_TABLE_DTYPE = np.dtype([
+    ("spectrum", "U64"),  # Spectrum.name
+    ("peak", "i4"),  # number of the peak in the spectrum, -1 if failed
+    ("centroid", "f8"),  # channel
+    ("centroid_error", "f8"),
+    ("sigma", "f8"),  # channels
+    ("sigma_error", "f8"),
+    ("amplitude", "f8"),  # counts
+    ("amplitude_error", "f8"),
+    ("status", "U64"),  # "ok", or why the fit failed
+])
+
+# fit_peaks arguments, used for anything not in a spectrum's settings
+DEFAULT_SETTINGS = {
+    "n_peaks": 1,
+    "peak_prominence": 100,
+    "peak_width": 5,
+    "background_width": 70,
+    "poisson": False,
+    "roi": False,
+    "background_degree": 1,
+}
+
+
+def fit_rows(spec: Spectrum, settings=None):
+    """Fit one spectrum, return its rows of the peak table."""
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    try:
+        peak_fit = peaks.fit_peaks(spec, **settings)
+    except (ValueError, RuntimeError) as error:
+        row = np.zeros(1, dtype=PEAK_TABLE_DTYPE)
+        for name in PEAK_TABLE_DTYPE.names:
+            if PEAK_TABLE_DTYPE[name] == np.float64:
+                row[name] = np.nan
+        row["spectrum"] = spec.name
+        row["peak"] = -1
+        row["status"] = f"{type(error).__name__}: {error}"[:64]
+        return row
+    fit = peak_fit.fit
+    errors = fit.errors
+    sigmas = np.sqrt(fit.variances)
+    rows = np.zeros(len(sigmas), dtype=PEAK_TABLE_DTYPE)
+    rows["spectrum"] = spec.name
+    rows["peak"] = np.arange(len(sigmas))
+    rows["centroid"] = fit.means
+    rows["centroid_error"] = errors[1::3]
+    rows["sigma"] = sigmas
+    # d(sigma) = d(variance) / (2 sigma)
+    rows["sigma_error"] = errors[2::3] / (2*sigmas)
+    rows["amplitude"] = peak_fit.amplitudes
+    rows["amplitude_error"] = errors[0::3]
+    rows["status"] = np.where(np.isfinite(errors).all(), "ok",
+                              "no covariance")
+    return rows
+
+
+def batch_fit(spectra, settings=None, workers=None):
+    """
+    Fit the peaks of many spectra in a pool of processes.
+
+    spectra: list of Spectrum objects
+    settings: dict of fit_peaks arguments (n_peaks, background_width,
+              ...) for all spectra, or a list with one dict per spectrum
+    workers: number of processes, default = number of cores
+    Returns a PEAK_TABLE_DTYPE array, in the same order as spectra.
+    """
+    spectra = list(spectra)
+    if settings is None or isinstance(settings, dict):
+        settings = [settings] * len(spectra)
+    if len(settings) != len(spectra):
+        raise ValueError(f"got {len(settings)} settings for "
+                         f"{len(spectra)} spectra")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fit_rows, spec, spec_settings)
+                   for spec, spec_settings in zip(spectra, settings)]
+        tables = [future.result() for future in futures]
+    return np.concatenate(tables) if tables \
+        else np.zeros(0, dtype=PEAK_TABLE_DTYPE)
+
+
+def print_table(table):
+    """Print a peak table."""
+    print(f"{'spectrum':<40} {'peak':>4} {'centroid':>10} {'error':>7} "
+          f"{'sigma':>7} {'error':>7} {'amplitude':>10} {'error':>8} status")
+    for row in table:
+        print(f"{row['spectrum']:<40} {row['peak']:4d} "
+              f"{row['centroid']:10.2f} {row['centroid_error']:7.3f} "
+              f"{row['sigma']:7.3f} {row['sigma_error']:7.3f} "
+              f"{row['amplitude']:10.1f} {row['amplitude_error']:8.2f} "
+              f"{row['status']}")
+
+
+def save_table(table, filename):
+    """Save a peak table as .csv, or .npy (keeps the dtype)."""
+    if filename.endswith(".npy"):
+        np.save(filename, table)
+        return
+    with open(filename, "w", encoding="utf-8") as csv_file:
+        csv_file.write(",".join(table.dtype.names) + "\n")
+        for row in table:
+            csv_file.write(",".join(str(value) for value in row) + "\n")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "patterns", nargs="+",
+        help="spectrum names or patterns, e.g. 'run*_co60_bandpass*'")
+    parser.add_argument(
+        "-d", dest="directory", default=DATA_DIR,
+        help="directory with the .Spe files")
+    parser.add_argument("-n", dest="n_peaks", type=int, default=1)
+    parser.add_argument("--peak-prominence", type=float, default=100)
+    parser.add_argument("--peak-width", type=float, default=5)
+    parser.add_argument("--background-width", type=float, default=70)
+    parser.add_argument(
+        "--poisson", action="store_true",
+        help="fit with a Poisson likelihood instead of least squares")
+    parser.add_argument(
+        "--roi", action="store_true",
+        help="fit each region of interest with its own local background")
+    parser.add_argument(
+        "--background-degree", type=int, default=1,
+        help="degree of the local background polynomial (with --roi)")
+    parser.add_argument(
+        "-j", dest="workers", type=int, default=None,
+        help="number of worker processes (default: number of cores)")
+    parser.add_argument(
+        "-o", dest="output", default=None,
+        help="save the table to this .csv or .npy file")
+    args = parser.parse_args()
+    catalog = SpectrumCatalog(args.directory)
+    names = [name for name in catalog.names
+             if any(fnmatch.fnmatch(name, p) for p in args.patterns)]
+    fit_settings = {
+        "n_peaks": args.n_peaks,
+        "peak_prominence": args.peak_prominence,
+        "peak_width": args.peak_width,
+        "background_width": args.background_width,
+        "poisson": args.poisson,
+        "roi": args.roi,
+        "background_degree": args.background_degree,
+    }
+    # the workers read the files, so don't load them here
+    peak_table = batch_fit(
+        [Spectrum(name, name, catalog.headers[name].filename)
+         for name in names], fit_settings, args.workers)
+    print_table(peak_table)
+    if args.output is not None:
+        save_table(peak_table, args.output)
@@ -1,14 +1,23 @@
-"""Module for detecting / fitting peaks."""
-import matplotlib.pyplot as plt
+"""
+Module for detecting / fitting peaks.
+
+The peaks of the calibration sources are only fitted when they're first
+used (by calibration_peaks, or e.g. peaks.peak_channels), not on import.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+import json
+import os
 import numpy as np
-from scipy.optimize import curve_fit
-from scipy.signal import find_peaks
 
-from read_spe import data, Spectrum, CHANNELS
-from gaussians import comb_gauss
+from read_spe import data, infer_source, Spectrum
+from gaussians import GaussFit, MultiGauss
 from peak_data import known_peaks
+import plotting
 
-plt.rcParams.update({'font.size': 30})
+FWHM_PER_SIGMA = 2*np.sqrt(2*np.log(2))  # ~2.355
+WARM_START_VERSION = 1  # cache files with a different version are ignored
 
 
 def integral(spectrum: Spectrum, range_tuple, step=1):
@@ -42,23 +51,47 @@ def activity(sample_spectrum: Spectrum, peak_channel_range, step=1):
     return smp_integral - bkg_integral
 
 
-def get_peaks(spec: Spectrum, n_peaks=1, peak_prominence=100, peak_width=5,
-              background_width=70, plot=False):
+@dataclass
+class PeakFit:
+    """Class for storing the result of fit_peaks."""
+
+    found_channels: np.ndarray  # peaks from find_peaks
+    widths: np.ndarray  # their widths from find_peaks
+    background_regions: list  # (start, stop) around each peak
+    background: np.ndarray  # quadratic background fit, in every channel
+    fit: GaussFit  # Gaussians fit on top of the background
+    fit_hist: np.ndarray  # the fit Gaussians (no background), every channel
+
+    @property
+    def amplitudes(self):
+        """Return the amplitude of each Gaussian."""
+        return self.fit.params[0::3]
+
+    @property
+    def means(self):
+        """Return the mean (channel) of each Gaussian."""
+        return self.fit.means
+
+    @property
+    def variances(self):
+        """Return the variance of each Gaussian."""
+        return self.fit.variances
+
+
+def find_best_peaks(spec: Spectrum, n_peaks=1, peak_prominence=100,
+                    peak_width=5):
     """
-    Get the largest n_peaks peaks in a given spectrum.
+    Return (channels, properties) of the n_peaks most prominent peaks.
 
-    spec: Spectrum object, for which to find peaks
-    n_peaks: int, we'll find some number of best peaks
-    peak_prominence: peaks must have at least this prominence
-    peak_width: peaks must have at least this width
-    background_width: take this width on either side of each peak
+    properties: dict of find_peaks properties (widths, prominences, ...)
+    Raises ValueError if fewer than n_peaks peaks are found.
     """
+    from scipy.signal import find_peaks  # slow to import, only when needed
+
     # find peak points and properties (like width)
     peak_chs, properties = find_peaks(
         spec.spectrum, prominence=peak_prominence, width=peak_width)
     if len(peak_chs) < n_peaks:
-        print(peak_chs)
-        print(spec.spectrum[peak_chs])
         raise ValueError(
             f"Less peaks found than are required {len(peak_chs)} < {n_peaks}. "
             "Try changing peak parameters like prominence and width.")
@@ -69,73 +102,375 @@ def get_peaks(spec: Spectrum, n_peaks=1, peak_prominence=100, peak_width=5,
     peak_chs = peak_chs[best_indices]
     properties = {k: properties[k][best_indices] for k in properties}
     # print("peaks before fitting: ", list(zip(peaks, spec.spectrum[peaks])))
+    return spec.channels[peak_chs], properties
 
-    # now select background regions around peaks
+
+def initial_guesses(peak_chs, properties):
+    """
+    Return (amplitude, mean, variance) guesses, an (n peaks x 3) array.
+
+    The amplitude is the peak's prominence (its height above the
+    background next to it), and find_peaks widths are at half the
+    prominence, so they're FWHMs: variance = (width / 2.355)**2.
+    """
+    return np.column_stack([
+        properties["prominences"],
+        peak_chs,
+        (properties["widths"] / FWHM_PER_SIGMA)**2,
+    ]).astype(float)
+
+
+def warm_start_key(spec: Spectrum):
+    """Return the WarmStartCache key of a spectrum, detector/source."""
+    source = infer_source(spec.filename)
+    if source == "unknown":
+        source = spec.name
+    return f"{spec.spe.detector}/{source}"
+
+
+class WarmStartCache():
+    """
+    Class for remembering peak fits, so the next fit can start from them.
+
+    Fits are stored by warm_start_key (detector/source). When the same
+    source is fitted again (e.g. the spectrum is updated during
+    acquisition), peaks that are within a width of a stored peak start
+    from its mean and variance. Amplitudes still come from the data, since
+    they grow as counts come in. With a filename, the cache is loaded from
+    and saved to that JSON file, so it works across runs.
+
+    Example:
+        cache = WarmStartCache("fit_cache.json")
+        get_peaks(data.Co60, n_peaks=2, warm_start=cache)
+    """
+
+    def __init__(self, filename=None):
+        """Make a cache, loaded from filename (JSON) if it exists."""
+        self.filename = filename
+        self.fits = {}  # key -> list of params, in comb_gauss order
+        if filename is not None and os.path.exists(filename):
+            with open(filename, "r", encoding="utf-8") as cache_file:
+                cache = json.load(cache_file)
+            if cache.get("version") == WARM_START_VERSION:
+                self.fits = cache["fits"]
+
+    def guesses(self, key, peak_chs, properties):
+        """Return initial_guesses, with stored means/variances if they fit."""
+        guesses = initial_guesses(peak_chs, properties)
+        if key not in self.fits:
+            return guesses
+        stored = np.reshape(self.fits[key], (-1, 3))
+        for guess, width in zip(guesses, properties["widths"]):
+            nearest = np.argmin(np.abs(stored[:, 1] - guess[1]))
+            if abs(stored[nearest, 1] - guess[1]) < width:
+                guess[1:] = stored[nearest, 1:]
+        return guesses
+
+    def update(self, key, params):
+        """Store the params of a fit (and save, if there's a filename)."""
+        self.fits[key] = [float(param) for param in params]
+        if self.filename is not None:
+            self.save()
+
+    def save(self, filename=None):
+        """Save the cache to a JSON file (default = self.filename)."""
+        filename = self.filename if filename is None else filename
+        with open(filename, "w", encoding="utf-8") as cache_file:
+            json.dump({"version": WARM_START_VERSION, "fits": self.fits},
+                      cache_file, indent=1)
+
+
+def fit_peaks(spec: Spectrum, n_peaks=1, peak_prominence=100, peak_width=5,
+              background_width=70, poisson=False, roi=False,
+              background_degree=1, workers=None, warm_start=None):
+    """
+    Find the largest n_peaks peaks in a spectrum and fit them, see get_peaks.
+
+    roi: bool, fit each region of interest around the peaks on its own
+         (see fit_rois), instead of all the peaks over the whole spectrum
+    background_degree: degree of the background polynomial in each ROI
+    workers: number of threads fitting ROIs at the same time
+    warm_start: WarmStartCache to start from (and store) the fit params,
+                otherwise the fit starts from initial_guesses
+    Returns a PeakFit, raises ValueError if not enough peaks are found
+    (and RuntimeError if the fit doesn't converge).
+    """
+    peak_chs, properties = find_best_peaks(spec, n_peaks, peak_prominence,
+                                           peak_width)
     widths = properties["widths"]
+    if warm_start is None:
+        guesses = initial_guesses(peak_chs, properties)
+    else:
+        key = warm_start_key(spec)
+        guesses = warm_start.guesses(key, peak_chs, properties)
+    if roi:
+        peak_fit = fit_rois(spec, peak_chs, widths, guesses,
+                            background_width, poisson, background_degree,
+                            workers)
+    else:
+        peak_fit = fit_global(spec, peak_chs, widths, guesses,
+                              background_width, poisson)
+    if warm_start is not None:
+        warm_start.update(key, peak_fit.fit.params)
+    return peak_fit
+
+
+def fit_global(spec: Spectrum, peak_chs, widths, guesses,
+               background_width=70, poisson=False):
+    """
+    Fit all the peaks at once, over the whole spectrum, see fit_peaks.
+
+    The background is a quadratic fit to the spectrum outside the peaks
+    (and the background_width regions next to them).
+    guesses: (n peaks x 3) array of initial (amplitude, mean, variance)
+    """
+    # now select background regions around peaks
     background_regions = []
     for peak, width in zip(peak_chs, widths):
         left = peak - 2*width
         right = peak + 2*width
         background_regions.append((left - background_width, left))
         background_regions.append((right, right + background_width))
-    mask_bkg = np.ones_like(CHANNELS, dtype=bool)
+    channels = spec.channels
+    mask_bkg = np.ones_like(channels, dtype=bool)
     for start, stop in background_regions:
-        mask_bkg = mask_bkg ^ ((CHANNELS > start) * (CHANNELS < stop))
+        mask_bkg = mask_bkg ^ ((channels > start) * (channels < stop))
 
     # and fit a sum of Gaussians to the peaks
-    initial_guesses = []
-    for peak in peak_chs:
-        initial_guesses += [1000, peak, 10]
-    coeff = np.polyfit(CHANNELS[mask_bkg], spec.spectrum[mask_bkg], 2)
-    bkgfit = np.polyval(coeff, CHANNELS)
-    coeff_gauss, *_ = curve_fit(
-        comb_gauss, CHANNELS, spec.spectrum-bkgfit, p0=initial_guesses)
-    fit_hist = comb_gauss(CHANNELS, *coeff_gauss)
-
-    fit_peaks = list(coeff_gauss[[i*3+1 for i in range(len((peak_chs)))]])
-    fit_stdevs = list(coeff_gauss[[i*3+2 for i in range(len((peak_chs)))]])
-
-    # now plot if needed
+    coeff = np.polyfit(channels[mask_bkg], spec.spectrum[mask_bkg], 2)
+    bkgfit = np.polyval(coeff, channels)
+    model = MultiGauss(len(peak_chs))
+    # expected counts have to be positive for a Poisson fit, so leave out
+    # channels where the quadratic background goes below 0
+    fit_chs = bkgfit > 0 if poisson else np.ones_like(channels, dtype=bool)
+    fit = model.fit(
+        channels[fit_chs], spec.spectrum[fit_chs], np.ravel(guesses),
+        background=bkgfit[fit_chs], poisson=poisson)
+    return PeakFit(
+        found_channels=peak_chs,
+        widths=widths,
+        background_regions=background_regions,
+        background=bkgfit,
+        fit=fit,
+        fit_hist=model(channels, *fit.params),
+    )
+
+
+def make_rois(peak_chs, widths, background_width=70):
+    """
+    Return a list of (start, stop, peak numbers) regions of interest.
+
+    Each peak gets [peak - 2*width - background_width,
+    peak + 2*width + background_width], and overlapping ones are merged so
+    multiplets are fitted together.
+    """
+    rois = []
+    for number in np.argsort(peak_chs):
+        half_width = 2*widths[number] + background_width
+        start = peak_chs[number] - half_width
+        stop = peak_chs[number] + half_width
+        if rois and start <= rois[-1][1]:
+            rois[-1] = (rois[-1][0], max(stop, rois[-1][1]),
+                        rois[-1][2] + [number])
+        else:
+            rois.append((start, stop, [number]))
+    return rois
+
+
+def fit_roi(channels, counts, peak_chs, widths, guesses, poisson=False,
+            background_degree=1):
+    """
+    Fit the peaks in one region of interest, with a local background.
+
+    channels, counts: arrays, just the ROI
+    peak_chs, widths: of the peaks in the ROI
+    guesses: (peaks in the ROI x 3) array of initial guesses
+    The background polynomial is fitted to the channels more than 2 widths
+    from all the peaks, then the Gaussians are fitted on top of it.
+    Returns (GaussFit, background in each channel).
+    """
+    mask_bkg = np.ones_like(channels, dtype=bool)
+    for peak, width in zip(peak_chs, widths):
+        mask_bkg &= np.abs(channels - peak) >= 2*width
+    if np.count_nonzero(mask_bkg) <= background_degree:
+        raise ValueError(
+            f"not enough background channels around peaks at {peak_chs}, "
+            "try a bigger background_width")
+    coeff = np.polyfit(channels[mask_bkg], counts[mask_bkg],
+                       background_degree)
+    bkgfit = np.polyval(coeff, channels)
+    fit_chs = bkgfit > 0 if poisson else np.ones_like(channels, dtype=bool)
+    fit = MultiGauss(len(peak_chs)).fit(
+        channels[fit_chs], counts[fit_chs], np.ravel(guesses),
+        background=bkgfit[fit_chs], poisson=poisson)
+    return fit, bkgfit
+
+
+def fit_rois(spec: Spectrum, peak_chs, widths, guesses, background_width=70,
+             poisson=False, background_degree=1, workers=None):
+    """
+    Fit the peaks in independent regions of interest, see make_rois.
+
+    Each ROI only has a few dozen channels and its own background, so a
+    bad start in one doesn't affect the others. ROIs are fitted at the
+    same time in a pool of workers threads. Returns a PeakFit like
+    fit_peaks (background is nan outside the ROIs), with the peaks in
+    order of channel.
+    """
+    from scipy.linalg import block_diag  # slow to import, only when needed
+
+    channels = spec.channels
+    order = np.argsort(peak_chs)
+    peak_chs, widths = np.asarray(peak_chs)[order], np.asarray(widths)[order]
+    guesses = np.asarray(guesses)[order]
+    rois = make_rois(peak_chs, widths, background_width)
+    slices = [slice(*np.searchsorted(channels, [start, stop]))
+              for start, stop, _ in rois]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(fit_roi, channels[roi_slice],
+                        spec.spectrum[roi_slice], peak_chs[numbers],
+                        widths[numbers], guesses[numbers], poisson,
+                        background_degree)
+            for roi_slice, (_, _, numbers) in zip(slices, rois)]
+        results = [future.result() for future in futures]
+
+    bkgfit = np.full(len(channels), np.nan)
+    for roi_slice, (_, roi_bkg) in zip(slices, results):
+        bkgfit[roi_slice] = roi_bkg
+    fit = GaussFit(
+        params=np.concatenate([result.params for result, _ in results]),
+        covariance=block_diag(*[result.covariance for result, _ in results]),
+        n_evaluations=sum(result.n_evaluations for result, _ in results))
+    # the background is the ROI outside the peaks
+    background_regions = []
+    for start, stop, numbers in rois:
+        background_regions.append(
+            (start, peak_chs[numbers[0]] - 2*widths[numbers[0]]))
+        background_regions.append(
+            (peak_chs[numbers[-1]] + 2*widths[numbers[-1]], stop))
+    return PeakFit(
+        found_channels=peak_chs,
+        widths=widths,
+        background_regions=background_regions,
+        background=bkgfit,
+        fit=fit,
+        fit_hist=MultiGauss(len(peak_chs))(channels, *fit.params),
+    )
+
+
+def get_peaks(spec: Spectrum, n_peaks=1, peak_prominence=100, peak_width=5,
+              background_width=70, plot=False, poisson=False, roi=False,
+              background_degree=1, warm_start=None):
+    """
+    Get the largest n_peaks peaks in a given spectrum.
+
+    spec: Spectrum object, for which to find peaks
+    n_peaks: int, we'll find some number of best peaks
+    peak_prominence: peaks must have at least this prominence
+    peak_width: peaks must have at least this width
+    background_width: take this width on either side of each peak
+    poisson: bool, fit with a Poisson likelihood (better for low counts),
+             instead of least squares on the background-subtracted counts
+    roi: bool, fit each region of interest around the peaks on its own,
+         with a local background_degree polynomial background (see fit_rois)
+    warm_start: WarmStartCache, start from the last fit of this source
+    Returns lists of the fit peak channels and variances.
+    """
+    peak_fit = fit_peaks(spec, n_peaks, peak_prominence, peak_width,
+                         background_width, poisson, roi, background_degree,
+                         warm_start=warm_start)
+    fit_peaks_chs = list(peak_fit.means)
+    fit_stdevs = list(peak_fit.variances)
+
+    # now plot if needed (see plotting.py for when it's made)
     if plot:
-        plt.figure(figsize=(50, 10))
-        plt.xlabel("Channel Number")
-        plt.ylabel("Counts")
-        plt.plot(CHANNELS, spec.spectrum, label=spec.label)
-        plt.plot(CHANNELS, bkgfit, label='Background fit')
-        plt.plot(CHANNELS, fit_hist, label='Gaussian peak fit')
-        for peak in fit_peaks:
-            plt.axvline(peak, c='r')
-        for start, stop in background_regions:
-            plt.axvspan(start, stop, alpha=0.1, color='m')
-        plt.legend(fontsize=30)
-        plt.xlim(min(peak_chs) - 1.5*background_width,
-                 max(peak_chs) + 1.5*background_width)
-        plt.tight_layout()
-        plt.savefig(f"images/peaks_{spec.name}.pdf")
-        plt.cla()
-        plt.clf()
-    return fit_peaks, fit_stdevs
-
-
-co_peak_channels, co_peak_stdevs = get_peaks(
-    data.Co60, n_peaks=2, background_width=100, plot=True)
-ba_peak_channels, ba_peak_stdevs = get_peaks(
-    data.Ba133, n_peaks=5, background_width=70, plot=True)
-# ignore annihilation peak at 511keV, find 2 peaks and take 2nd one
-na_peak_channels, na_peak_stdevs = get_peaks(
-    data.Na22, n_peaks=2, background_width=400, plot=True)
-na_peak_channels = [na_peak_channels[1]]
-na_peak_stdevs = [na_peak_stdevs[1]]
-
-# see which peaks correspond to which real peaks
-co_peak_energies = known_peaks.Co60.peaks_kev
-ba_peak_energies = known_peaks.Ba133.peaks_kev
-na_peak_energies = known_peaks.Na22.peaks_kev
-
-peak_channels = co_peak_channels + ba_peak_channels + na_peak_channels
-peak_energies = co_peak_energies + ba_peak_energies + na_peak_energies
-peak_stdevs = co_peak_stdevs + ba_peak_stdevs + na_peak_stdevs
-
-
-# to be used in energy_calibration.py
-peaks = [(chan, energy) for chan, energy in zip(peak_channels, peak_energies)]
+        peak_chs = peak_fit.found_channels
+        plotting.plot(
+            plot_peaks, spec, peak_fit.background, peak_fit.fit_hist,
+            fit_peaks_chs, peak_fit.background_regions,
+            xlim=(min(peak_chs) - 1.5*background_width,
+                  max(peak_chs) + 1.5*background_width))
+    return fit_peaks_chs, fit_stdevs
+
+
+def plot_peaks(spec: Spectrum, bkgfit, fit_hist, fit_peaks,
+               background_regions, xlim):
+    """Plot a spectrum and its peak fit, save as images/peaks_<name>.pdf."""
+    plt = plotting.pyplot()
+    plt.rcParams.update({'font.size': 30})
+    plt.figure(figsize=(50, 10))
+    plt.xlabel("Channel Number")
+    plt.ylabel("Counts")
+    plt.plot(spec.channels, spec.spectrum, label=spec.label)
+    plt.plot(spec.channels, bkgfit, label='Background fit')
+    plt.plot(spec.channels, fit_hist, label='Gaussian peak fit')
+    for peak in fit_peaks:
+        plt.axvline(peak, c='r')
+    for start, stop in background_regions:
+        plt.axvspan(start, stop, alpha=0.1, color='m')
+    plt.legend(fontsize=30)
+    plt.xlim(*xlim)
+    plt.tight_layout()
+    plt.savefig(f"images/peaks_{spec.name}.pdf")
+    plt.close()
+
+
+@lru_cache(maxsize=None)
+def calibration_peaks():
+    """
+    Fit the peaks of the calibration sources, the first time it's called.
+
+    Returns a dict with the channels, energies and stdevs of the peaks
+    (the names in CALIBRATION_NAMES), each can also be used as peaks.<name>.
+    """
+    co_peak_channels, co_peak_stdevs = get_peaks(
+        data.Co60, n_peaks=2, background_width=100, plot=True)
+    ba_peak_channels, ba_peak_stdevs = get_peaks(
+        data.Ba133, n_peaks=5, background_width=70, plot=True)
+    # ignore annihilation peak at 511keV, find 2 peaks and take 2nd one
+    na_peak_channels, na_peak_stdevs = get_peaks(
+        data.Na22, n_peaks=2, background_width=400, plot=True)
+    na_peak_channels = [na_peak_channels[1]]
+    na_peak_stdevs = [na_peak_stdevs[1]]
+
+    # see which peaks correspond to which real peaks
+    co_peak_energies = known_peaks.Co60.peaks_kev
+    ba_peak_energies = known_peaks.Ba133.peaks_kev
+    na_peak_energies = known_peaks.Na22.peaks_kev
+
+    peak_channels = co_peak_channels + ba_peak_channels + na_peak_channels
+    peak_energies = co_peak_energies + ba_peak_energies + na_peak_energies
+    peak_stdevs = co_peak_stdevs + ba_peak_stdevs + na_peak_stdevs
+
+    # to be used in energy_calibration.py
+    peaks = list(zip(peak_channels, peak_energies))
+    return {
+        "co_peak_channels": co_peak_channels,
+        "co_peak_stdevs": co_peak_stdevs,
+        "co_peak_energies": co_peak_energies,
+        "ba_peak_channels": ba_peak_channels,
+        "ba_peak_stdevs": ba_peak_stdevs,
+        "ba_peak_energies": ba_peak_energies,
+        "na_peak_channels": na_peak_channels,
+        "na_peak_stdevs": na_peak_stdevs,
+        "na_peak_energies": na_peak_energies,
+        "peak_channels": peak_channels,
+        "peak_energies": peak_energies,
+        "peak_stdevs": peak_stdevs,
+        "peaks": peaks,
+    }
+
+
+CALIBRATION_NAMES = [
+    "co_peak_channels", "co_peak_stdevs", "co_peak_energies",
+    "ba_peak_channels", "ba_peak_stdevs", "ba_peak_energies",
+    "na_peak_channels", "na_peak_stdevs", "na_peak_energies",
+    "peak_channels", "peak_energies", "peak_stdevs", "peaks"]
+
+
+def __getattr__(name):
+    """Return calibration_peaks()[name] for the names that used to be here."""
+    if name in CALIBRATION_NAMES:
+        return calibration_peaks()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
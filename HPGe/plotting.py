@@ -0,0 +1,86 @@
+"""
+Module for deciding when (and if) plots get made.
+
+Analysis code gives plot() a render function and the data to plot, and the
+mode decides what happens:
+- "now": render it right away (the default)
+- "deferred": save it for later, render_pending() makes all the plots
+- "parallel": save it for later, render_pending() makes them in a pool of
+  processes (big figures take a while)
+- "off": don't make it, matplotlib isn't even imported (for batch runs)
+The mode can be set with set_mode, or with the GRIDS_PLOTS environment
+variable, e.g. GRIDS_PLOTS=off python activity.py
+
+Render functions have to be module-level functions (so they can be sent to
+other processes) and should get pyplot from pyplot() here.
+
+HPGe, BiPo and M11_GRIDS each have the same copy of this file on purpose:
+every experiment directory is self-contained (built on its own with its
+Dockerfile), so a change here should be made in all three.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+MODES = ("now", "deferred", "parallel", "off")
+ENV_VARIABLE = "GRIDS_PLOTS"
+
+_pending = []  # (render, args, kwargs) waiting for render_pending
+
+
+def set_mode(mode):
+    """Set the plotting mode, one of MODES."""
+    global _mode
+    if mode not in MODES:
+        raise ValueError(f"plot mode must be one of {MODES}, not {mode!r}")
+    _mode = mode
+
+
+def get_mode():
+    """Return the plotting mode."""
+    return _mode
+
+
+set_mode(os.environ.get(ENV_VARIABLE, "now"))
+
+
+def pyplot():
+    """Return matplotlib.pyplot, only imported once a plot is made."""
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def plot(render, *args, **kwargs):
+    """Call render(*args, **kwargs) now, later, or never (see MODES)."""
+    if _mode == "off":
+        return
+    if _mode == "now":
+        render(*args, **kwargs)
+        return
+    _pending.append((render, args, kwargs))
+
+
+def _render(render, args, kwargs):
+    """Render one plot in a worker process, without a display."""
+    import matplotlib
+    matplotlib.use("Agg")
+    render(*args, **kwargs)
+
+
+def render_pending(workers=None):
+    """
+    Make all the plots saved by plot(), return how many were made.
+
+    In "parallel" mode they're made in a pool of workers processes
+    (default = number of cores), otherwise one after another.
+    """
+    jobs = _pending[:]
+    _pending.clear()
+    if _mode == "parallel" and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_render, *job) for job in jobs]
+            for future in futures:
+                future.result()
+    else:
+        for render, args, kwargs in jobs:
+            render(*args, **kwargs)
+    return len(jobs)
@@ -1,35 +1,168 @@
-"""Module for reading data from .Spe files."""
+"""
+Module for reading data from .Spe files.
 
-from dataclasses import dataclass
+A .Spe file (from Maestro) is made of sections like
+    $MEAS_TIM:
+    180 243
+    $DATA:
+    0 8191
+           0
+           ...
+parse_spe reads a file once, takes the header sections it needs, and
+converts the whole $DATA block to numbers in one go. The number of
+channels comes from the $DATA range, so 4k/16k MCAs work too.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import cached_property, partial
+import glob
+import os
+import re
+import threading
 import numpy as np
 
-N_CHANNELS = 8191
-START_LINE = 13
+N_CHANNELS = 8192  # for the 8k MCA, use Spectrum.channels for others
+DATE_FORMAT = "%m/%d/%Y %H:%M:%S"  # $DATE_MEA, e.g. 06/16/2022 16:37:18
 
 CHANNELS = np.arange(0, N_CHANNELS, 1)
-CO60_FILE = 'data/frun3_co60_live180s.Spe'
-BA133_FILE = 'data/frun1_ba133_live180s.Spe'
-NA22_FILE = 'data/frun2_na22_live180s.Spe'
-X_FILE = 'data/frun4_source_live5400s.Spe'
-BKG_FILE = 'data/frun5_bkg_live5400s.Spe'
+
+DATA_DIR = 'data'
+MAX_RESIDENT = 32  # default number of spectra a catalog keeps in memory
+
+# the spectra used in the analysis: alias -> (file in DATA_DIR, label)
+DEFAULT_ALIASES = {
+    "Co60": ('frun3_co60_live180s.Spe', r'$^{60}Co$'),
+    "Ba133": ('frun1_ba133_live180s.Spe', r'$^{133}Ba$'),
+    "Na22": ('frun2_na22_live180s.Spe', r'$^{22}Na$'),
+    "bkg": ('frun5_bkg_live5400s.Spe', 'background'),
+    "x": ('frun4_source_live5400s.Spe', 'X'),
+}
+
+# sections parse_spe turns into SpeFile fields, the rest go in extra_sections
+MAIN_SECTIONS = ("SPEC_ID", "DATE_MEA", "MEAS_TIM", "DATA")
+
+# which source a file has, from its name (first match wins)
+SOURCE_PATTERNS = [
+    ("Co60", r"co60"),
+    ("Ba133", r"ba133"),
+    ("Na22", r"na22"),
+    ("bkg", r"bkg|background"),
+    ("x", r"source|myst|mist"),
+]
+
+
+@dataclass
+class SpeFile:
+    """Class for storing the contents of a .Spe file."""
+
+    filename: str
+    spec_id: str  # sample description
+    date: datetime  # start of the measurement, None if not given
+    live_time: int  # seconds
+    real_time: int  # seconds
+    first_channel: int
+    last_channel: int
+    counts: np.ndarray  # counts in each channel, None if only the header
+    detector: str = ""  # DETDESC# (or DET#) from $SPEC_REM
+    # the other sections ($SPEC_REM, $ROI, $MCA_CAL, ...), name -> text,
+    # only the ones before $DATA if header_only
+    extra_sections: dict = field(default_factory=dict)
+
+    @property
+    def n_channels(self):
+        """Return the number of channels."""
+        return self.last_channel - self.first_channel + 1
+
+    @property
+    def channels(self):
+        """Return the channel numbers."""
+        return np.arange(self.first_channel, self.last_channel + 1)
+
+
+def _split_sections(text):
+    """Return {section name: text after the name} for some .Spe text."""
+    sections = {}
+    for block in ("\n" + text).split("\n$")[1:]:
+        name, _, body = block.partition(":")
+        sections[name] = body.strip()
+    return sections
+
+
+def _read_header(spe_file):
+    """Return the .Spe sections up to and including the $DATA range."""
+    lines = []
+    for line in spe_file:
+        lines.append(line)
+        if line.startswith("$DATA"):
+            lines.append(spe_file.readline())
+            break
+    return _split_sections("".join(lines))
+
+
+def parse_spe(spe_filename, header_only=False):
+    """
+    Return a SpeFile with the header (and counts) of a .Spe file.
+
+    header_only: bool, stop reading at the start of $DATA (counts = None),
+                 quick for scanning lots of files
+    """
+    with open(spe_filename, "r", encoding="utf-8") as spe_file:
+        if header_only:
+            sections = _read_header(spe_file)
+        else:
+            sections = _split_sections(spe_file.read())
+    if "DATA" not in sections or "MEAS_TIM" not in sections:
+        raise ValueError(f"{spe_filename} has no $DATA or $MEAS_TIM section")
+    channel_range, _, data_block = sections["DATA"].partition("\n")
+    first_channel, last_channel = map(int, channel_range.split())
+    live, real = map(int, sections["MEAS_TIM"].split()[:2])
+    date = sections.get("DATE_MEA", "")
+    counts = None
+    if not header_only:
+        # all the counts in one go, much quicker than int() on every line
+        counts = np.fromstring(data_block, dtype=np.int64, sep=" ")
+        if len(counts) != last_channel - first_channel + 1:
+            raise ValueError(
+                f"{spe_filename} has {len(counts)} counts, but $DATA says "
+                f"channels {first_channel} to {last_channel}")
+    remarks = dict(line.partition("# ")[::2] for line
+                   in sections.get("SPEC_REM", "").splitlines())
+    return SpeFile(
+        filename=spe_filename,
+        spec_id=sections.get("SPEC_ID", ""),
+        date=datetime.strptime(date, DATE_FORMAT) if date else None,
+        live_time=live,
+        real_time=real,
+        first_channel=first_channel,
+        last_channel=last_channel,
+        counts=counts,
+        detector=remarks.get("DETDESC", remarks.get("DET", "")).strip(),
+        extra_sections={name: text for name, text in sections.items()
+                        if name not in MAIN_SECTIONS},
+    )
+
+
+def infer_source(spe_filename):
+    """Return the source (Co60, Ba133, Na22, bkg or x) from a file name."""
+    name = os.path.basename(spe_filename).lower()
+    for source, pattern in SOURCE_PATTERNS:
+        if re.search(pattern, name):
+            return source
+    return "unknown"
 
 
 def read(spe_filename):
     """Given a .Spe file, return the data as a numpy array."""
-    with open(spe_filename, "r", encoding="utf-8") as spe_file:
-        spe_lines = spe_file.readlines()
-    data_lines = spe_lines[START_LINE:START_LINE+N_CHANNELS]
-    data_nums = [int(d.strip().replace("\n", "")) for d in data_lines]
-    return np.array(data_nums)
+    return parse_spe(spe_filename).counts
 
 
 def read_time(spe_filename):
     """Get live_time and real_time from a .Spe file."""
-    with open(spe_filename, "r", encoding="utf-8") as spe_file:
-        time_line = spe_file.readlines()[9]  # example: 245 245
-        time_line = time_line.strip().replace("\n", "")
-        live, real = map(int, time_line.split())
-    return live, real
+    header = parse_spe(spe_filename, header_only=True)
+    return header.live_time, header.real_time
 
 
 def live_time(spe_filename):
@@ -38,31 +171,216 @@ def live_time(spe_filename):
 
 
 def real_time(spe_filename):
-    """Get live_time from a .Spe file."""
+    """Get real_time from a .Spe file."""
     return read_time(spe_filename)[1]
 
 
 class Spectrum():
-    """Class for keeping track of spectrum names & data."""
+    """
+    Class for keeping track of spectrum names & data.
+
+    The file is only read (once) when spectrum, live_time or channels
+    is first used.
+    """
 
     def __init__(self, name: str, label: str, filename: str) -> None:
-        """Create object by reading data from filename."""
+        """Create object, data is read from filename when it's needed."""
         self.name = name
         self.label = label
         self.filename = filename
-        self.spectrum = read(self.filename)
-        self.live_time = live_time(self.filename)
 
+    @classmethod
+    def from_archive(cls, archive, key, label=None):
+        """
+        Make a Spectrum from a row of a spectrum_archive.SpectrumArchive.
 
-@dataclass
-class SpeData():
-    """Class for storing data about spectra read from files."""
+        key: row number or name, label: default = name
+        spectrum is a view of the archive's counts, nothing is copied or
+        read from the .Spe file.
+        """
+        entry = archive.entries[archive.index(key)]
+        spectrum = cls(entry.name, entry.name if label is None else label,
+                       entry.filename)
+        spectrum.spe = archive.spe_file(key)
+        spectrum.spectrum = spectrum.spe.counts
+        spectrum.live_time = spectrum.spe.live_time
+        return spectrum
+
+    @cached_property
+    def spe(self):
+        """Return the SpeFile (read the first time)."""
+        return parse_spe(self.filename)
+
+    @cached_property
+    def spectrum(self):
+        """Return the counts in each channel."""
+        return self.spe.counts
+
+    @cached_property
+    def live_time(self):
+        """Return the live time."""
+        return self.spe.live_time
+
+    @property
+    def channels(self):
+        """Return the channel numbers of spectrum."""
+        return self.spe.channels
+
+
+class SpectrumCatalog():
+    """
+    Class for finding and loading the .Spe files in a directory.
+
+    The directory is scanned (headers only) the first time the catalog
+    is used, so new runs just need to be put in the directory. Spectra
+    are read when they're first asked for, and the most recently used
+    max_resident of them are kept in memory.
+
+    Example:
+        catalog = SpectrumCatalog("data")
+        catalog["run2_co60"]  # Spectrum, by file name without .Spe
+        catalog.select("bkg")  # names of the background runs
+        catalog.live_time("run7_mystery_source")  # from the header
+        catalog.load_all()  # read all the files in a pool of threads
+
+        data = SpectrumCatalog("data", aliases=DEFAULT_ALIASES)
+        data.Co60  # Spectrum named Co60, from frun3_co60_live180s.Spe
+
+    An alias and its file name share one read of the file (and one of the
+    max_resident places), only the Spectrum name and label differ.
+    """
+
+    def __init__(self, directory=DATA_DIR, aliases=None,
+                 max_resident=MAX_RESIDENT, workers=None, pattern="*.Spe"):
+        """
+        Create a catalog, nothing is read yet.
+
+        directory: where the .Spe files are
+        aliases: dict of alias -> (file name in directory, label), aliases
+                 can be used like names and as attributes (catalog.Co60)
+        max_resident: how many spectra to keep in memory (None = all)
+        workers: number of threads for scanning / load_all
+        pattern: glob pattern for the files in directory
+        """
+        self.directory = directory
+        self.aliases = {} if aliases is None else dict(aliases)
+        self.max_resident = max_resident
+        self.workers = workers
+        self.pattern = pattern
+        self._resident = OrderedDict()  # name -> Spectrum, oldest first
+        self._alias_spectra = {}  # alias -> Spectrum sharing a resident spe
+        self._lock = threading.Lock()
+
+    @cached_property
+    def headers(self):
+        """Return {name: SpeFile with no counts} for every file (scanned)."""
+        paths = sorted(glob.glob(os.path.join(self.directory, self.pattern)))
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            headers = list(pool.map(
+                partial(parse_spe, header_only=True), paths))
+        return {os.path.splitext(os.path.basename(path))[0]: header
+                for path, header in zip(paths, headers)}
+
+    @property
+    def names(self):
+        """Return the names (file names without extension) of the spectra."""
+        return list(self.headers)
+
+    @property
+    def resident(self):
+        """Return the names of the spectra in memory, oldest first."""
+        with self._lock:
+            return list(self._resident)
+
+    def _name(self, key):
+        """Return the name of a spectrum from its name or alias."""
+        if key in self.aliases:
+            return os.path.splitext(self.aliases[key][0])[0]
+        if key not in self.headers:
+            raise KeyError(f"no spectrum {key!r} in {self.directory}")
+        return key
+
+    def source(self, key):
+        """Return the source of a spectrum (see infer_source)."""
+        return infer_source(self.headers[self._name(key)].filename)
+
+    def live_time(self, key):
+        """Return the live time of a spectrum, without reading the counts."""
+        return self.headers[self._name(key)].live_time
+
+    def select(self, source):
+        """Return the names of the spectra with a given source, e.g. bkg."""
+        return [name for name in self.names if self.source(name) == source]
+
+    def __getitem__(self, key):
+        """Return the Spectrum for a name or alias, read if needed."""
+        name = self._name(key)
+        with self._lock:
+            spectrum = self._resident.get(name)
+            if spectrum is not None:
+                self._resident.move_to_end(name)
+        if spectrum is None:
+            spectrum = Spectrum(name, name, self.headers[name].filename)
+            spectrum.spe = parse_spe(spectrum.filename)
+            with self._lock:
+                # another thread might have read it too, keep the first one
+                spectrum = self._resident.setdefault(name, spectrum)
+                self._resident.move_to_end(name)
+                while (self.max_resident is not None
+                       and len(self._resident) > self.max_resident):
+                    _, evicted = self._resident.popitem(last=False)
+                    self._forget_aliases(evicted)
+        if key in self.aliases:
+            return self._aliased(key, spectrum)
+        return spectrum
+
+    def _aliased(self, alias, spectrum):
+        """Return spectrum with an alias's name and label (same SpeFile)."""
+        with self._lock:
+            aliased = self._alias_spectra.get(alias)
+            if aliased is None or aliased.spe is not spectrum.spe:
+                aliased = Spectrum(alias, self.aliases[alias][1],
+                                   spectrum.filename)
+                aliased.spe = spectrum.spe
+                self._alias_spectra[alias] = aliased
+            return aliased
+
+    def _forget_aliases(self, spectrum):
+        """Drop the alias Spectrum objects of an evicted spectrum."""
+        for alias, aliased in list(self._alias_spectra.items()):
+            if aliased.spe is spectrum.spe:
+                del self._alias_spectra[alias]
+
+    def __getattr__(self, key):
+        """Return the Spectrum for an alias, e.g. catalog.Co60."""
+        if key.startswith("_") or key not in self.__dict__.get("aliases", {}):
+            raise AttributeError(
+                f"{type(self).__name__!r} object has no attribute {key!r}")
+        return self[key]
+
+    def __contains__(self, key):
+        """Return True if key is a name or alias in the catalog."""
+        return key in self.aliases or key in self.headers
+
+    def __iter__(self):
+        """Iterate over the names of the spectra."""
+        return iter(self.names)
+
+    def __len__(self):
+        """Return the number of spectra."""
+        return len(self.headers)
+
+    def load_all(self, keys=None, workers=None):
+        """
+        Read some spectra (default = all) in a pool of threads.
 
-    Co60 = Spectrum("Co60", r'$^{60}Co$', CO60_FILE)
-    Ba133 = Spectrum("Ba133", r'$^{133}Ba$', BA133_FILE)
-    Na22 = Spectrum("Na22", r'$^{22}Na$', NA22_FILE)
-    bkg = Spectrum("bkg", 'background', BKG_FILE)
-    x = Spectrum("x", 'X', X_FILE)
+        Returns a list of Spectrum objects. Only the last max_resident stay
+        in the catalog, but the ones returned are all read.
+        """
+        keys = self.names if keys is None else list(keys)
+        workers = self.workers if workers is None else workers
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(self.__getitem__, keys))
 
 
-data = SpeData()
+data = SpectrumCatalog(DATA_DIR, aliases=DEFAULT_ALIASES)
@@ -0,0 +1,210 @@
+"""
+Module for putting spectra on a common energy grid.
+
+Each channel covers an energy range (its edges, channel +- 0.5, through a
+Calibration), and its counts are shared between the grid bins it
+overlaps, in proportion to the overlap, so counts are conserved. That
+sharing is a sparse (grid bins x channels) matrix, made once for each
+calibration and reused, so rebinning many spectra is one sparse matrix
+product per calibration. Runs with different gains (e.g. the bandpass /
+pole-zero runs) can then be summed and compared bin by bin.
+
+Example:
+    rebinner = Rebinner(energy_grid(0, 2000, 0.5))
+    rebinned = rebinner.rebin_many(spectra, calibrations)
+    total = rebinned.sum(axis=0)  # summed on the common grid
+
+    python rebin.py "run*_co60_bandpass*"
+"""
+from argparse import ArgumentParser
+import fnmatch
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+
+from read_spe import DATA_DIR, Spectrum, SpectrumCatalog
+from energy_calibration import Calibration, default_calibration
+from peak_data import known_peaks
+import peaks
+import plotting
+
+
+def energy_grid(start, stop, width):
+    """Return the edges of equal width energy bins from start to stop."""
+    return np.arange(start, stop + width/2, width, dtype=float)
+
+
+def bin_centres(edges):
+    """Return the centres of the bins with the given edges."""
+    edges = np.asarray(edges)
+    return (edges[:-1] + edges[1:]) / 2
+
+
+def channel_edges(calibration: Calibration, channels):
+    """
+    Return the energy edges of channels (channel +- 0.5, not below 0).
+
+    channels: consecutive channel numbers, e.g. Spectrum.channels
+    """
+    channels = np.asarray(channels)
+    edges = np.append(channels - 0.5, channels[-1] + 0.5)
+    return calibration.energy(np.maximum(edges, 0))
+
+
+def overlap_matrix(source_edges, dest_edges):
+    """
+    Return the sparse (dest bins x source bins) rebinning matrix.
+
+    Element [j, i] is the fraction of source bin i that's inside dest bin
+    j, so matrix @ counts conserves the counts within the dest range.
+    Both sets of edges have to be increasing.
+    """
+    source_edges = np.asarray(source_edges, dtype=float)
+    dest_edges = np.asarray(dest_edges, dtype=float)
+    if np.any(np.diff(source_edges) <= 0) or np.any(np.diff(dest_edges) <= 0):
+        raise ValueError("bin edges must be increasing")
+    shape = (len(dest_edges) - 1, len(source_edges) - 1)
+    low = max(source_edges[0], dest_edges[0])
+    high = min(source_edges[-1], dest_edges[-1])
+    if low >= high:
+        return csr_matrix(shape)
+    # every piece between consecutive edges is in one source and one dest
+    edges = np.union1d(source_edges, dest_edges)
+    edges = edges[(edges >= low) & (edges <= high)]
+    middles = bin_centres(edges)
+    source = np.searchsorted(source_edges, middles) - 1
+    dest = np.searchsorted(dest_edges, middles) - 1
+    weights = np.diff(edges) / np.diff(source_edges)[source]
+    # duplicate (dest, source) pairs are added up when converting to csr
+    return coo_matrix((weights, (dest, source)), shape=shape).tocsr()
+
+
+class Rebinner():
+    """
+    Class for rebinning spectra onto one energy grid.
+
+    The overlap matrix for each (calibration, channels) is cached, so
+    spectra with the same calibration are rebinned with the same matrix.
+    """
+
+    def __init__(self, energy_edges):
+        """Make a rebinner for the grid with these edges (keV)."""
+        self.energy_edges = np.asarray(energy_edges, dtype=float)
+        self._matrices = {}  # see _key
+
+    @property
+    def energies(self):
+        """Return the centres of the grid bins."""
+        return bin_centres(self.energy_edges)
+
+    @staticmethod
+    def _key(calibration: Calibration, channels):
+        """Return what a cached matrix is looked up by."""
+        return (calibration.model, calibration.degree,
+                calibration.coefficients.tobytes(),
+                int(channels[0]), len(channels))
+
+    def matrix(self, calibration: Calibration, channels):
+        """Return the (cached) overlap matrix for a calibration."""
+        key = self._key(calibration, channels)
+        if key not in self._matrices:
+            self._matrices[key] = overlap_matrix(
+                channel_edges(calibration, channels), self.energy_edges)
+        return self._matrices[key]
+
+    def rebin(self, counts, calibration=None, channels=None):
+        """
+        Return counts on the grid, for spectra with the same calibration.
+
+        counts: array of counts (channels), or (spectra x channels)
+        calibration: default = energy_calibration.default_calibration()
+        channels: channel numbers of the columns, default = 0, 1, ...
+        """
+        counts = np.asarray(counts)
+        if calibration is None:
+            calibration = default_calibration()
+        if channels is None:
+            channels = np.arange(counts.shape[-1])
+        matrix = self.matrix(calibration, channels)
+        return (matrix @ counts.T).T
+
+    def rebin_many(self, spectra, calibrations=None):
+        """
+        Return a (spectra x grid bins) array of rebinned spectra.
+
+        spectra: list of Spectrum objects
+        calibrations: one Calibration for all of them, or a list with one
+                      each (default = default_calibration())
+        Spectra with the same calibration are rebinned together.
+        """
+        spectra = list(spectra)
+        if calibrations is None or isinstance(calibrations, Calibration):
+            calibrations = [calibrations] * len(spectra)
+        if len(calibrations) != len(spectra):
+            raise ValueError(f"got {len(calibrations)} calibrations for "
+                             f"{len(spectra)} spectra")
+        calibrations = [default_calibration() if calibration is None
+                        else calibration for calibration in calibrations]
+        groups = {}  # key -> rows with that calibration and channels
+        for row, (spec, calibration) in enumerate(zip(spectra,
+                                                      calibrations)):
+            key = self._key(calibration, spec.channels)
+            groups.setdefault(key, []).append(row)
+        rebinned = np.zeros((len(spectra), len(self.energies)))
+        for rows in groups.values():
+            first = spectra[rows[0]]
+            rebinned[rows] = self.rebin(
+                np.stack([spectra[row].spectrum for row in rows]),
+                calibrations[rows[0]], first.channels)
+        return rebinned
+
+
+def calibrate_co60(spec: Spectrum, **fit_settings):
+    """Return a line Calibration from the two Co60 peaks in a spectrum."""
+    settings = {"n_peaks": 2, "background_width": 100, **fit_settings}
+    peak_fit = peaks.fit_peaks(spec, **settings)
+    return Calibration.from_points(peak_fit.means,
+                                   known_peaks.Co60.peaks_kev)
+
+
+def plot_rebinned(energies, rebinned, labels, filename):
+    """Plot rebinned spectra (per second) on their common energy axis."""
+    plt = plotting.pyplot()
+    plt.figure(figsize=(15, 10))
+    for counts, label in zip(rebinned, labels):
+        plt.plot(energies, counts, label=label)
+    plt.xlabel("Energy [keV]")
+    plt.ylabel("Counts / s")
+    plt.legend()
+    plt.savefig(filename)
+    plt.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "patterns", nargs="+",
+        help="Co60 spectrum names or patterns, e.g. 'run*_co60_bandpass*'")
+    parser.add_argument(
+        "-d", dest="directory", default=DATA_DIR,
+        help="directory with the .Spe files")
+    parser.add_argument(
+        "--width", type=float, default=1, help="energy bin width, keV")
+    args = parser.parse_args()
+    catalog = SpectrumCatalog(args.directory)
+    names = [name for name in catalog.names
+             if any(fnmatch.fnmatch(name, p) for p in args.patterns)]
+    co60_spectra = catalog.load_all(names)
+    # each run has its own gain, so its own calibration from the Co60 peaks
+    run_calibrations = [calibrate_co60(spec) for spec in co60_spectra]
+    co60_rebinner = Rebinner(energy_grid(0, 1500, args.width))
+    co60_rebinned = co60_rebinner.rebin_many(co60_spectra, run_calibrations)
+    for spec, calibration, row in zip(co60_spectra, run_calibrations,
+                                      co60_rebinned):
+        print(f"{spec.name:<45} {calibration.coefficients[0]:.5f} keV/ch, "
+              f"{int(spec.spectrum.sum()):8d} counts, "
+              f"{row.sum():10.1f} on the grid")
+    live_times = np.array([spec.live_time for spec in co60_spectra])
+    plotting.plot(plot_rebinned, co60_rebinner.energies,
+                  co60_rebinned / live_times[:, None], names,
+                  "images/rebinned_spectra.pdf")
+    plotting.render_pending()
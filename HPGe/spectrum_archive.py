@@ -0,0 +1,228 @@
+"""
+Module for storing lots of spectra together in one archive.
+
+An archive is a directory with
+- counts.npy: (spectra x channels) counts, loaded as a memory map, so
+  only the rows (or columns) that are used get read
+- metadata.json: one entry per row (name, file, live/real time, date,
+  source, detector, ...), with the other .Spe header sections ($SPEC_REM,
+  $ROI, $MCA_CAL, ...) as text, so export_spe can write them back
+so comparing many spectra is array slicing instead of parsing text.
+Spectra with fewer channels than the biggest one are padded with zeros
+(see n_channels).
+
+Example:
+    python spectrum_archive.py data/*.Spe -o spectra_archive
+
+    archive = load_archive("spectra_archive")
+    rates = archive.counts / archive.live_times[:, None]
+    co60 = archive.spectrum("frun3_co60_live180s")  # a read_spe.Spectrum
+    export_spe(archive, "run2_co60", "run2_co60_copy.Spe")
+"""
+from argparse import ArgumentParser
+from dataclasses import dataclass, asdict
+from datetime import datetime
+import json
+import os
+import numpy as np
+
+from read_spe import DATE_FORMAT, SpeFile, Spectrum, infer_source, parse_spe
+
+ARCHIVE_VERSION = 2  # archives with a different version can't be loaded
+COUNTS_FILE = "counts.npy"
+METADATA_FILE = "metadata.json"
+
+
+@dataclass
+class ArchiveEntry:
+    """Class for storing the metadata of one spectrum in an archive."""
+
+    name: str  # unique in the archive, default = file name without .Spe
+    filename: str  # .Spe file it was imported from
+    source: str  # see infer_source
+    spec_id: str
+    date: str  # ISO format, "" if not known
+    live_time: int  # seconds
+    real_time: int  # seconds
+    first_channel: int
+    n_channels: int  # the rest of the row is padding
+    detector: str  # see SpeFile.detector
+    extra_sections: dict  # see SpeFile.extra_sections
+
+
+@dataclass
+class SpectrumArchive:
+    """Class for storing an archive's counts (memory mapped) and metadata."""
+
+    directory: str
+    counts: np.ndarray  # (spectra x channels)
+    entries: list  # ArchiveEntry for each row of counts
+
+    def __len__(self):
+        """Return the number of spectra."""
+        return len(self.entries)
+
+    @property
+    def names(self):
+        """Return the name of each spectrum."""
+        return [entry.name for entry in self.entries]
+
+    @property
+    def live_times(self):
+        """Return an array with the live time of each spectrum."""
+        return np.array([entry.live_time for entry in self.entries])
+
+    @property
+    def real_times(self):
+        """Return an array with the real time of each spectrum."""
+        return np.array([entry.real_time for entry in self.entries])
+
+    def index(self, key):
+        """Return the row of a spectrum, key = row number or name."""
+        if isinstance(key, (int, np.integer)):
+            return int(key)
+        return self.names.index(key)
+
+    def select(self, source):
+        """Return the rows with a given source, e.g. "bkg"."""
+        return [row for row, entry in enumerate(self.entries)
+                if entry.source == source]
+
+    def spe_file(self, key):
+        """Return a SpeFile whose counts are a view of the archive row."""
+        entry = self.entries[self.index(key)]
+        return SpeFile(
+            filename=entry.filename,
+            spec_id=entry.spec_id,
+            date=datetime.fromisoformat(entry.date) if entry.date else None,
+            live_time=entry.live_time,
+            real_time=entry.real_time,
+            first_channel=entry.first_channel,
+            last_channel=entry.first_channel + entry.n_channels - 1,
+            counts=self.counts[self.index(key), :entry.n_channels],
+            detector=entry.detector,
+            extra_sections=dict(entry.extra_sections),
+        )
+
+    def spectrum(self, key, label=None):
+        """Return a Spectrum for a row (no copy), see Spectrum.from_archive."""
+        return Spectrum.from_archive(self, key, label)
+
+
+def import_spe(spe_filenames, archive_dir, names=None):
+    """
+    Make an archive from some .Spe files, return it (loaded).
+
+    Files are read one at a time and written straight to counts.npy.
+    spe_filenames: list of .Spe files
+    archive_dir: directory for the archive (made if needed, files in it
+                 are overwritten)
+    names: list of names, default = file names without .Spe
+    """
+    spe_filenames = list(spe_filenames)
+    if names is None:
+        names = [os.path.splitext(os.path.basename(f))[0]
+                 for f in spe_filenames]
+    if len(set(names)) != len(names):
+        raise ValueError("spectrum names in an archive must be unique")
+    headers = [parse_spe(f, header_only=True) for f in spe_filenames]
+    width = max((header.n_channels for header in headers), default=0)
+    os.makedirs(archive_dir, exist_ok=True)
+    counts = np.lib.format.open_memmap(
+        os.path.join(archive_dir, COUNTS_FILE), mode="w+",
+        dtype=np.int64, shape=(len(spe_filenames), width))
+    entries = []
+    for row, (name, spe_filename) in enumerate(zip(names, spe_filenames)):
+        spe = parse_spe(spe_filename)
+        counts[row, :spe.n_channels] = spe.counts
+        counts[row, spe.n_channels:] = 0
+        entries.append(ArchiveEntry(
+            name=name,
+            filename=spe_filename,
+            source=infer_source(spe_filename),
+            spec_id=spe.spec_id,
+            date=spe.date.isoformat() if spe.date else "",
+            live_time=spe.live_time,
+            real_time=spe.real_time,
+            first_channel=spe.first_channel,
+            n_channels=spe.n_channels,
+            detector=spe.detector,
+            extra_sections=spe.extra_sections,
+        ))
+    counts.flush()
+    del counts
+    with open(os.path.join(archive_dir, METADATA_FILE), "w",
+              encoding="utf-8") as metadata_file:
+        json.dump({"version": ARCHIVE_VERSION,
+                   "entries": [asdict(entry) for entry in entries]},
+                  metadata_file, indent=1)
+    return load_archive(archive_dir)
+
+
+def load_archive(archive_dir, mmap_mode="r"):
+    """
+    Return the SpectrumArchive in archive_dir.
+
+    mmap_mode: passed to np.load, "r" = read only memory map,
+               None = read all the counts into memory
+    """
+    with open(os.path.join(archive_dir, METADATA_FILE), "r",
+              encoding="utf-8") as metadata_file:
+        metadata = json.load(metadata_file)
+    if metadata.get("version") != ARCHIVE_VERSION:
+        raise ValueError(
+            f"{archive_dir} is archive version {metadata.get('version')}, "
+            f"this code reads version {ARCHIVE_VERSION}")
+    counts = np.load(os.path.join(archive_dir, COUNTS_FILE),
+                     mmap_mode=mmap_mode)
+    entries = [ArchiveEntry(**entry) for entry in metadata["entries"]]
+    if len(entries) != len(counts):
+        raise ValueError(f"{archive_dir} has {len(counts)} spectra but "
+                         f"{len(entries)} metadata entries")
+    return SpectrumArchive(archive_dir, counts, entries)
+
+
+def export_spe(archive: SpectrumArchive, key, spe_filename):
+    """
+    Write one spectrum (row number or name) of an archive to a .Spe.
+
+    The other header sections ($SPEC_REM, $ROI, $MCA_CAL, ...) are
+    written back as they were in the original file, in Maestro's order.
+    """
+    spe = archive.spe_file(key)
+    date = spe.date.strftime(DATE_FORMAT) if spe.date else ""
+    extra = dict(spe.extra_sections)
+    remarks = extra.pop("SPEC_REM", None)
+    lines = ["$SPEC_ID:", spe.spec_id]
+    if remarks is not None:
+        lines += ["$SPEC_REM:", remarks]
+    lines += [
+        "$DATE_MEA:", date,
+        "$MEAS_TIM:", f"{spe.live_time} {spe.real_time}",
+        "$DATA:", f"{spe.first_channel} {spe.last_channel}",
+        *(f"{count:8d}" for count in spe.counts),
+    ]
+    for name, text in extra.items():
+        lines += [f"${name}:", text]
+    with open(spe_filename, "w", encoding="utf-8") as spe_file:
+        spe_file.write("\n".join(lines) + "\n")
+
+
+def print_entries(archive: SpectrumArchive):
+    """Print the metadata of an archive as a table."""
+    print(f"{'row':>4} {'name':<45} {'source':<7} {'date':<19} "
+          f"{'live [s]':>8} {'real [s]':>8} {'counts':>9}")
+    for row, entry in enumerate(archive.entries):
+        print(f"{row:4d} {entry.name:<45} {entry.source:<7} "
+              f"{entry.date:<19} {entry.live_time:8d} {entry.real_time:8d} "
+              f"{int(archive.counts[row].sum()):9d}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("files", nargs="+", help=".Spe files to archive")
+    parser.add_argument(
+        "-o", dest="archive_dir", default="spectra_archive",
+        help="directory to write the archive to")
+    args = parser.parse_args()
+    print_entries(import_spe(sorted(args.files), args.archive_dir))
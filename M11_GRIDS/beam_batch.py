@@ -0,0 +1,248 @@
+"""
+Module for calculating the beam momentum of many runs in one go.
+
+Each run file is read and fitted (no plots) in a pool of processes.
+The ToF counts and fit result of each run are saved in a small cache,
+checked against the file's path, size and modification time, so running
+this again after new runs arrive only processes the new files.
+Runs whose fit failed (see fit_status) or that raised an error are kept
+in the table, with the reason in their status, and aren't cached.
+
+Example:
+    python beam_batch.py "output_*.root" -j 4
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import glob
+import hashlib
+import os
+import timeit
+import numpy as np
+
+import beam_momentum as bm
+import midas_data
+
+DEFAULT_CACHE_DIR = "beam_cache"
+CACHE_VERSION = 2  # caches made with a different version are redone
+
+
+@dataclass
+class RunSummary:
+    """Class for storing the beam momentum result from one run file."""
+
+    run: str  # file name without .root
+    n_events: int
+    e_mean: float  # fitted ToF means, ns
+    mu_mean: float
+    pi_mean: float
+    offset: float  # mean electron offset, ns
+    momentum: float  # MeV/c
+    momentum_error: float
+    cached: bool  # True if this came from the cache
+    seconds: float  # time taken to read and fit (when it wasn't cached)
+    status: str  # "ok", or why the result can't be used, see fit_status
+
+
+def cache_filename(root_file_path, cache_dir=DEFAULT_CACHE_DIR):
+    """Return the cache file for a run, one per (absolute) path."""
+    path = os.path.abspath(root_file_path)
+    key = hashlib.sha1(path.encode()).hexdigest()[:12]
+    run = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f"{run}_{key}.npz")
+
+
+def file_key(root_file_path):
+    """Return (path, size, mtime), what the cache is checked against."""
+    stat = os.stat(root_file_path)
+    return os.path.abspath(root_file_path), stat.st_size, stat.st_mtime_ns
+
+
+def save_cache(root_file_path, counts, result, seconds,
+               cache_dir=DEFAULT_CACHE_DIR):
+    """Save the TofCounts and MomentumResult of a run."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path, size, mtime = file_key(root_file_path)
+    np.savez(cache_filename(root_file_path, cache_dir),
+             version=CACHE_VERSION, path=path, size=size, mtime=mtime,
+             seconds=seconds, tdc_diffs=counts.tdc_diffs,
+             counts=counts.counts, **vars(result))
+
+
+def load_cache(root_file_path, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Return (TofCounts, MomentumResult, seconds) from the cache.
+
+    Returns None if there's no cache for this file, if the file's
+    size or modification time changed since it was cached, or if the
+    cache was made with another CACHE_VERSION.
+    """
+    filename = cache_filename(root_file_path, cache_dir)
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as cache:
+        if ("version" not in cache.files
+                or int(cache["version"]) != CACHE_VERSION):
+            return None
+        if (str(cache["path"]), int(cache["size"]), int(cache["mtime"])) \
+                != file_key(root_file_path):
+            return None
+        counts = bm.TofCounts()
+        counts.tdc_diffs = cache["tdc_diffs"]
+        counts.counts = cache["counts"]
+        result = bm.MomentumResult(**{
+            name: cache[name] if cache[name].ndim else cache[name].item()
+            for name in bm.MomentumResult.__dataclass_fields__})
+        return counts, result, float(cache["seconds"])
+
+
+def fit_status(counts, result):
+    """
+    Return "ok", or why a run's MomentumResult can't be used.
+
+    A run with nothing in the ToF histogram (e.g. cosmics) "fits" with
+    the initial guesses, and a fit that didn't converge has a non-finite
+    covariance, neither of them is a measurement.
+    """
+    if bm.tof_histogram(counts)[0].sum() == 0:
+        return "no ToF counts"
+    if not np.all(np.isfinite(result.covariance)):
+        return "no covariance"
+    if not np.isfinite(result.offset_mean):
+        return "no offset"
+    if not np.isfinite(result.momentum):
+        return "no momentum"
+    return "ok"
+
+
+def summarize(root_file_path, counts, result, cached, seconds):
+    """Return the RunSummary for a run's TofCounts and MomentumResult."""
+    e_mean, mu_mean, pi_mean = result.means
+    return RunSummary(
+        run=os.path.splitext(os.path.basename(root_file_path))[0],
+        n_events=result.n_events,
+        e_mean=e_mean,
+        mu_mean=mu_mean,
+        pi_mean=pi_mean,
+        offset=result.offset_mean,
+        momentum=result.momentum,
+        momentum_error=result.momentum_error,
+        cached=cached,
+        seconds=seconds,
+        status=fit_status(counts, result),
+    )
+
+
+def failed_summary(root_file_path, error):
+    """Return a RunSummary (nan results) for a run that raised an error."""
+    return RunSummary(
+        run=os.path.splitext(os.path.basename(root_file_path))[0],
+        n_events=0,
+        e_mean=np.nan,
+        mu_mean=np.nan,
+        pi_mean=np.nan,
+        offset=np.nan,
+        momentum=np.nan,
+        momentum_error=np.nan,
+        cached=False,
+        seconds=np.nan,
+        # one line, so it fits in the table
+        status=" ".join(f"{type(error).__name__}: {error}".split())[:64],
+    )
+
+
+def analyse_file(root_file_path, cache_dir=DEFAULT_CACHE_DIR,
+                 step_size=midas_data.STEP_SIZE):
+    """
+    Read and fit one run, return its RunSummary.
+
+    Only runs with status "ok" are saved in the cache, so the others are
+    tried again next time.
+    """
+    start = timeit.default_timer()
+    counts = bm.tof_counts(root_file_path, step_size)
+    result = bm.analyse(counts)
+    seconds = timeit.default_timer() - start
+    summary = summarize(root_file_path, counts, result, False, seconds)
+    if summary.status == "ok":
+        save_cache(root_file_path, counts, result, seconds, cache_dir)
+    return summary
+
+
+def batch(patterns, workers=None, cache_dir=DEFAULT_CACHE_DIR,
+          step_size=midas_data.STEP_SIZE):
+    """
+    Return a list of RunSummaries (sorted by run) for all matching files.
+
+    patterns: glob pattern or list of them, e.g. "output_*.root"
+    workers: number of processes, default = number of cores
+    cache_dir: where the per-run caches go
+    step_size: number of entries to read at a time
+    A run that can't be read or fitted (e.g. a corrupt file) gets a
+    summary with nan results and the error as its status, instead of
+    stopping the whole batch.
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    filenames = sorted({name for pattern in patterns
+                        for name in glob.glob(pattern)})
+    summaries = []
+    to_do = []
+    for filename in filenames:
+        cached = load_cache(filename, cache_dir)
+        if cached is None:
+            to_do.append(filename)
+        else:
+            counts, result, seconds = cached
+            summaries.append(
+                summarize(filename, counts, result, True, seconds))
+    if to_do:
+        print(f"processing {len(to_do)} new runs "
+              f"({len(summaries)} already cached)")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(analyse_file, name, cache_dir, step_size)
+                       for name in to_do]
+            for name, future in zip(to_do, futures):
+                try:
+                    summaries.append(future.result())
+                except Exception as error:  # e.g. a corrupt file
+                    summaries.append(failed_summary(name, error))
+    return sorted(summaries, key=lambda summary: summary.run)
+
+
+def print_table(summaries):
+    """Print RunSummaries as a table, failed fits are marked in status."""
+    print(f"{'run':>14} {'events':>9} {'e [ns]':>8} {'mu [ns]':>8} "
+          f"{'pi [ns]':>8} {'offset [ns]':>12} {'p [MeV/c]':>10} "
+          f"{'error':>6} {'time [s]':>9} status")
+    for res in summaries:
+        cached = " (cached)" if res.cached else ""
+        print(f"{res.run:>14} {res.n_events:9d} {res.e_mean:8.3f} "
+              f"{res.mu_mean:8.3f} {res.pi_mean:8.3f} {res.offset:12.3f} "
+              f"{res.momentum:10.2f} {res.momentum_error:6.2f} "
+              f"{res.seconds:9.2f} {res.status}{cached}")
+    failed = [res.run for res in summaries if res.status != "ok"]
+    if failed:
+        print(f"{len(failed)} of {len(summaries)} fits failed, don't use "
+              f"them: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "patterns", nargs="+",
+        help="root files or glob patterns, e.g. 'output_*.root'")
+    parser.add_argument(
+        "-j", dest="workers", type=int, default=None,
+        help="number of worker processes (default: number of cores)")
+    parser.add_argument(
+        "--cache-dir", default=DEFAULT_CACHE_DIR,
+        help="directory for the per-run caches")
+    parser.add_argument(
+        "--step-size", type=int, default=midas_data.STEP_SIZE,
+        help="number of entries to read at a time")
+    args = parser.parse_args()
+    start_time = timeit.default_timer()
+    print_table(batch(args.patterns, workers=args.workers,
+                      cache_dir=args.cache_dir, step_size=args.step_size))
+    print(f"total time: {timeit.default_timer() - start_time:.2f} s")
@@ -0,0 +1,212 @@
+"""
+Module for identifying particles event by event in M11 beam runs.
+
+The e/mu/pi Gaussians fitted by beam_momentum.analyse are the expected
+number of each particle at a given ToF, so for each event the probability
+of each species is that Gaussian over the sum of all three. The events are
+then written to a table with the ToF, PID, momentum and ADC values, so
+PMT studies can pick out e.g. muons without redoing the fit. The format
+comes from the file name: Parquet for .parquet (needs pyarrow), NPZ for
+anything else.
+
+Example:
+    python beam_events.py -f output_000496.root -o events_000496.npz
+
+    columns, files = read_events("events_000496.npz")
+    muons = columns["pid"] == SPECIES.index("mu")
+    plt.hist(columns["adc_C2"][muons])
+"""
+from argparse import ArgumentParser
+import json
+import os
+import numpy as np
+
+import beam_momentum as bm
+from gaussians import gauss
+import midas_data
+
+SPECIES = ["e", "mu", "pi"]  # order of the Gaussians in the fit
+MASSES = [bm.ELECTRON_MASS, bm.MUON_MASS, bm.PION_MASS]  # MeV
+NO_PID = -1  # pid of events without a ToF (or below min_probability)
+
+
+def _parquet():
+    """Return pyarrow and pyarrow.parquet, with a clear error if missing."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as error:
+        raise ImportError(
+            "reading or writing .parquet event files needs pyarrow "
+            "(pip install pyarrow), or use a .npz file name") from error
+    return pa, pq
+
+
+def pid_probabilities(delta_t, coeff):
+    """
+    Return an (events x 3) array of e/mu/pi probabilities.
+
+    delta_t: array of BC3-BC1 ToFs, ns
+    coeff: comb_gauss params from beam_momentum.fit_tof
+    Rows are nan for events with no ToF (delta_t = 0), or so far from all
+    the Gaussians that they're all 0.
+    """
+    delta_t = np.asarray(delta_t, dtype=float)
+    amps, means, variances = coeff[0::3], coeff[1::3], coeff[2::3]
+    expected = gauss(delta_t[:, None], amps, means, variances)
+    expected = np.clip(expected, 0, None)  # in case an amplitude is < 0
+    with np.errstate(invalid="ignore"):
+        probabilities = expected / expected.sum(axis=1, keepdims=True)
+    probabilities[delta_t == 0] = np.nan
+    return probabilities
+
+
+def classify(probabilities, min_probability=0):
+    """
+    Return the most likely species (index in SPECIES) for each event.
+
+    Events with nan probabilities, or where the most likely species has
+    probability < min_probability, get NO_PID.
+    """
+    known = np.isfinite(probabilities).all(axis=1)
+    best = np.argmax(np.where(known[:, None], probabilities, 0), axis=1)
+    best_probability = np.where(
+        known, probabilities[np.arange(len(best)), best], 0)
+    return np.where(known & (best_probability >= min_probability),
+                    best, NO_PID).astype(np.int8)
+
+
+def event_momenta(delta_t, pid, result: bm.MomentumResult):
+    """
+    Return (momenta, errors) in MeV/c using the mass of each event's PID.
+
+    Muons and pions only: electrons (beta~1, so the ToF says nothing about
+    momentum) and NO_PID events get nan.
+    """
+    momenta = np.full(len(delta_t), np.nan)
+    errors = np.full(len(delta_t), np.nan)
+    for species in ("mu", "pi"):
+        index = SPECIES.index(species)
+        this_species = pid == index
+        momenta[this_species], errors[this_species] = bm.event_momenta(
+            delta_t[this_species], result, MASSES[index])
+    return momenta, errors
+
+
+def event_table(data: midas_data.MidasData, result: bm.MomentumResult,
+                min_probability=0):
+    """Return a dict of event columns (all arrays of the same length)."""
+    tdc_data = data.tdc_data
+    delta_t = (tdc_data['BC3'] - tdc_data['BC1']) / 10
+    probabilities = pid_probabilities(delta_t, result.coeff)
+    pid = classify(probabilities, min_probability)
+    momenta, errors = event_momenta(delta_t, pid, result)
+    columns = {
+        "delta_t": delta_t,
+        "tof": delta_t - result.offset_mean,
+        "pid": pid,
+    }
+    for index, species in enumerate(SPECIES):
+        columns[f"prob_{species}"] = probabilities[:, index]
+    columns["momentum"] = momenta
+    columns["momentum_error"] = errors
+    for name, values in data.adc_data.items():
+        columns[f"adc_{name}"] = values
+    return columns
+
+
+def _chunks(root_file_paths, step_size):
+    """Yield (file number, first entry, MidasData) for each chunk."""
+    for file_number, path in enumerate(root_file_paths):
+        first_entry = 0
+        for chunk in midas_data.iterate(path, step_size):
+            yield file_number, first_entry, chunk
+            first_entry += len(chunk)
+
+
+def write_events(root_file_paths, result: bm.MomentumResult, filename,
+                 min_probability=0, step_size=midas_data.STEP_SIZE):
+    """
+    Write the event table of some root files, read a chunk at a time.
+
+    Besides the event_table columns, "file_number" (index in
+    root_file_paths) and "entry" (entry number in that file) say where
+    each event came from.
+    filename: a .parquet name gives a Parquet file (written chunk by
+              chunk, needs pyarrow), anything else gives .npz (columns
+              are collected in memory first, np.savez adds .npz to the
+              name if it's missing)
+    """
+    if isinstance(root_file_paths, str):
+        root_file_paths = [root_file_paths]
+    parquet = filename.endswith(".parquet")
+    if parquet:
+        pa, pq = _parquet()
+        metadata = {"files": json.dumps(list(root_file_paths))}
+        writer = None
+    else:
+        collected = []
+    for file_number, first_entry, chunk in _chunks(root_file_paths,
+                                                   step_size):
+        columns = {
+            "file_number": np.full(len(chunk), file_number, dtype=np.int16),
+            "entry": first_entry + np.arange(len(chunk)),
+            **event_table(chunk, result, min_probability),
+        }
+        if parquet:
+            table = pa.table(columns).replace_schema_metadata(metadata)
+            if writer is None:
+                writer = pq.ParquetWriter(filename, table.schema)
+            writer.write_table(table)
+        else:
+            collected.append(columns)
+    if parquet:
+        if writer is not None:
+            writer.close()
+    else:
+        names = collected[0].keys() if collected else []
+        np.savez(filename, files=np.array(root_file_paths, dtype=str),
+                 **{name: np.concatenate([cols[name] for cols in collected])
+                    for name in names})
+
+
+def read_events(filename):
+    """Return (dict of columns, list of root files) from write_events."""
+    if filename.endswith(".parquet"):
+        _, pq = _parquet()
+        table = pq.read_table(filename)
+        files = json.loads(table.schema.metadata[b"files"])
+        columns = {name: table[name].to_numpy()
+                   for name in table.column_names}
+        return columns, files
+    with np.load(filename) as npz:
+        columns = {name: npz[name] for name in npz.files if name != "files"}
+        return columns, npz["files"].tolist()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "-f", dest="files", nargs="+", default=[bm.DEFAULT_ROOT_FILE_NAME],
+        help="path to root file(s) with beam data, from one momentum setting")
+    parser.add_argument(
+        "-o", dest="output", default=None,
+        help="output file, .npz or .parquet (default: events_<run>.npz)")
+    parser.add_argument(
+        "--min-probability", type=float, default=0,
+        help="events with a lower probability for their PID get -1")
+    parser.add_argument(
+        "--step-size", type=int, default=midas_data.STEP_SIZE,
+        help="number of entries to read at a time")
+    args = parser.parse_args()
+    output = args.output
+    if output is None:
+        run = os.path.splitext(os.path.basename(args.files[0]))[0]
+        output = f"events_{run.replace('output_', '')}.npz"
+    if output.endswith(".parquet"):
+        _parquet()  # fail before the fit if pyarrow is missing, not after
+    print("fitting ToF histogram")
+    momentum_result = bm.analyse(bm.tof_counts(args.files, args.step_size))
+    print(f"writing events to {output}")
+    write_events(args.files, momentum_result, output,
+                 args.min_probability, args.step_size)
@@ -5,215 +5,392 @@ Things this does:
 - makes a histogram of ToF data where we triggered on BC3/2 coincidences
 - fits Gaussians for electrons, muons, and pions
 - calculates the offset time due to cable length etc
-- eventually calculates beam momentum by comparing to calculated values
+- eventually calculates beam momentum from the muon and pion ToFs
+
+Files are read a chunk of entries at a time (see midas_data.iterate), and
+only the ToF histogram is kept in memory, so big runs are fine. Several
+files from the same momentum setting can be combined into one histogram:
+    python beam_momentum.py -f output_000496.root output_000499.root
 """
 from argparse import ArgumentParser
-import uproot
+from dataclasses import dataclass
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-from scipy.optimize import curve_fit
+
+from gaussians import MultiGauss, comb_gauss, gauss
+import midas_data
+import plotting
 
 # put your file name here (can override this with -f argument)
 DEFAULT_ROOT_FILE_NAME = 'output_000496.root'
 
-# a couple helper functions for curve fitting:
+# ToF histogram that gets fitted
+TOF_BINS = 179
+TOF_RANGE = (-10, 8)  # ns
 
+# constants
+LENGTH = 3.18  # measured length in meters, between the two scintillators
+C_M_PER_NS = 0.2997925  # speed of light in m/ns
+ELECTRON_MASS = 0.511  # MeV
+MUON_MASS = 105.660  # MeV
+PION_MASS = 139.570  # MeV
+MOMENTA = np.arange(50, 300, 1)  # MeV/c, momenta for the ToF vs p plot
 
-def gauss(xvals, amp, mean, var):
-    """Return a Gaussian with the given x values and parameters.
 
-    xvals: numpy array of x values
-    amp: number, amplitude of Gaussian
-    mean: number, mean of Gaussian
-    var: variance of Gaussian
+class TofCounts():
     """
-    return amp*np.exp(-(xvals-mean)**2/(2*var))
+    Class for counting BC3-BC1 TDC differences, one bin per TDC count.
 
+    Since the TDC only gives whole counts (0.1 ns), counting each value
+    keeps all the information in delta_t: the fixed-bin ToF histogram and
+    the electron offset sums can be made exactly from these counts once the
+    fit is done, without keeping (or re-reading) the events.
+    """
 
-def comb_gauss(xvals, *params):
-    """Return a sum of Gaussians.
+    def __init__(self):
+        """Start with no counts."""
+        self.tdc_diffs = np.zeros(0, dtype=np.int64)  # sorted, unique
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def _merge(self, tdc_diffs, counts):
+        """Add counts for some TDC differences (any order, repeats ok)."""
+        all_diffs = np.concatenate([self.tdc_diffs, tdc_diffs])
+        all_counts = np.concatenate([self.counts, counts])
+        self.tdc_diffs, inverse = np.unique(all_diffs, return_inverse=True)
+        self.counts = np.bincount(
+            inverse, weights=all_counts).astype(np.int64)
+
+    def add(self, tdc_data):
+        """Count the BC3-BC1 differences of a dict of TDC columns."""
+        diffs, counts = np.unique(
+            tdc_data['BC3'] - tdc_data['BC1'], return_counts=True)
+        self._merge(diffs, counts)
+
+    def __iadd__(self, other):
+        """Add the counts from another TofCounts."""
+        self._merge(other.tdc_diffs, other.counts)
+        return self
+
+    def __len__(self):
+        """Return the number of events counted."""
+        return int(self.counts.sum())
+
+    @property
+    def delta_t(self):
+        """ToF in ns for each TDC difference (divide by 10, like before)."""
+        return self.tdc_diffs / 10
+
+
+def tof_counts(root_file_paths, step_size=midas_data.STEP_SIZE):
+    """
+    Return TofCounts for one or more root files, read in chunks.
 
-    xvals: numpy array of x values
-    params: list of parameters to pass, must have length being a multiple of 3
-            (amplitude, mean, variance) for each Gaussian
+    root_file_paths: path or list of paths, all go in the same TofCounts
+    step_size: number of entries (or e.g. "100 MB") to read at a time
     """
-    assert len(params) % 3 == 0
-    distr = 0
-    for j in range(len(params) // 3):
-        distr += gauss(xvals, *[params[j*3], params[j*3+1], params[j*3+2]])
-    return distr
+    counts = TofCounts()
+    for chunk in midas_data.iterate(root_file_paths, step_size,
+                                    branches=["tdc_value"]):
+        counts.add(chunk.tdc_data)
+    return counts
 
 
-# the main function to calculate beam momentum:
+def tof_histogram(counts: TofCounts):
+    """Return (hist, bins) of the non-zero ToFs, what gets fitted."""
+    # mask zeros so we don't get spikes
+    mask = counts.delta_t != 0
+    return np.histogram(counts.delta_t[mask], TOF_BINS, range=TOF_RANGE,
+                        weights=counts.counts[mask])
 
 
-def calculate_momentum(root_file_path):
-    """given a root file, calculate beam momentum"""
-    # constants
-    length = 3.18  # measured length in meters, between the two scintillators
-    c_m_per_ns = 0.2997925  # speed of light in m/ns
-
-    # set plot parameters
-    matplotlib.rcParams.update({'font.size': 22})
-
-    # open root file, put adc/tdc data in numpy arrays
-    print("opening file, reorganizing data")
-    beam_file = uproot.open(root_file_path)
-    beam_data = beam_file['midas_data']
-    tdc = beam_data['tdc_value'].array(library="np", entry_start=0)
-    adc = beam_data['adc_value'].array(library="np", entry_start=0)
-
-    # put adc and tdc data into dicts with keys corresponding to detectors
-    # BC1/2/3 = Scintillator number 1/2/3
-    # C2/3/4/5/6 = PMT number 2/3/4/5/6
-    adc_data = {'BC1': [], 'BC2': [], 'BC3': [],
-                'C2': [], 'C3': [], 'C4': [], 'C5': [], 'C6': []}
-    for adc_i in adc:
-        adc_data['BC1'].append(adc_i[0])
-        adc_data['BC2'].append(adc_i[1])
-        adc_data['BC3'].append(adc_i[2])
-        adc_data['C2'].append(adc_i[3])
-        adc_data['C3'].append(adc_i[4])
-        adc_data['C4'].append(adc_i[5])
-        adc_data['C5'].append(adc_i[6])
-        adc_data['C6'].append(adc_i[7])
-    tdc_data = {'BC1': [], 'BC2': [], 'BC3': []}
-    for tdc_i in tdc:
-        tdc_data['BC1'].append(tdc_i[1])
-        tdc_data['BC2'].append(tdc_i[2])
-        tdc_data['BC3'].append(tdc_i[3])
-
-    # cast as arrays so it's faster
-    for k in adc_data:
-        adc_data[k] = np.array(adc_data[k])
-    for k in tdc_data:
-        tdc_data[k] = np.array(tdc_data[k])
-
-    print("fitting curves, making histogram")
-
-    # calculate TOF delta t using BC3-BC1 (divide by 10 so it's in nanoseconds)
-    delta_t = (tdc_data['BC3']-tdc_data['BC1']) / 10
+def bin_centres(bins):
+    """Return the centres of histogram bins."""
+    return bins[:-1] + (bins[1]-bins[0])/2
 
-    # mask zeros so we don't get spikes
-    mask = delta_t != 0
 
-    # make a histogram
-    plt.figure(figsize=(12, 8))
-    plt.title('beam')
-    plt.xlabel('time-of-flight: BC3-BC1, ns')
-    plt.ylabel('counts')
-    hist, bins, _ = plt.hist(
-        delta_t[mask], 179, range=(-10, 8), histtype='step', lw=3)
+def fit_tof(hist, bins, poisson=False):
+    """Fit e/mu/pi Gaussians to a ToF histogram.
 
-    # fit a curve
-    bin_centres = bins[:-1] + (bins[1]-bins[0])/2
-    coeff, *_ = curve_fit(
+    poisson: bool, use a Poisson likelihood fit instead of least squares
+             (gives correct errors when there are bins with few counts)
+    Returns (comb_gauss params, their covariance matrix).
+    """
+    fit = MultiGauss(3).fit(
         # p0 = initial guesses, sorry about the magic numbers here
-        comb_gauss, bin_centres, hist,
-        p0=[4000, -5, 1, 16000, -1, 1, 4000, 2, 1])
-    fit_hist = comb_gauss(bin_centres, *coeff)
+        bin_centres(bins), hist,
+        p0=[4000, -5, 1, 16000, -1, 1, 4000, 2, 1], poisson=poisson)
+    return fit.params, fit.covariance
 
-    # get a mask for just the electrons, muons, pions
+
+def electron_mask(delta_t, coeff):
+    """Return a mask of non-zero ToFs within 2 sigma of the electron mean."""
     e_sigma = np.sqrt(coeff[2])
     e_mean = coeff[1]
-    m_mean = coeff[4]
-    p_mean = coeff[7]
+    return ((delta_t != 0)
+            * (delta_t > e_mean-2*e_sigma) * (delta_t < e_mean+2*e_sigma))
+
+
+def electron_offset(counts: TofCounts, coeff):
+    """
+    Return (offsets, weights, mean offset) for the electrons, in ns.
+
+    offset = time taken for electronics to do their thing
+    we assume our particles are really travelling around speed of light, so
+    to get the offset we take our measured time minus time light would take
+    """
+    mask_e = electron_mask(counts.delta_t, coeff)
+    offset = counts.delta_t[mask_e] - LENGTH/C_M_PER_NS
+    weights = counts.counts[mask_e]
+    with np.errstate(invalid='ignore'):
+        offset_mean = np.sum(offset * weights) / np.sum(weights)
+    return offset, weights, offset_mean
+
+
+def get_tof(mass, momentum=MOMENTA):
+    """Get time of flight for a given mass at a bunch of different momenta.
+    Mass is in MeV, momentum in MeV/c, ToF in ns.
+    """
+    e_total = np.sqrt(momentum**2 + mass**2)
+    beta = momentum / e_total
+    tof = LENGTH / (beta * C_M_PER_NS)
+    return tof
+
+
+def momentum_from_tof(tof, mass, tof_error=None):
+    """Return the momentum (MeV/c) of a particle with a given ToF (ns).
+
+    This is get_tof solved for the momentum:
+        beta = LENGTH / (C_M_PER_NS * tof),  p = mass*beta/sqrt(1-beta^2)
+    tof: number or array, nan is returned where beta would be >= 1
+         (faster than light) or the ToF isn't positive
+    tof_error: number or array, if given (p, p error) is returned, using
+               dp/dtof = -p/(tof*(1-beta^2))
+    """
+    tof = np.asarray(tof, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta = LENGTH / (C_M_PER_NS * tof)
+        beta = np.where((beta > 0) & (beta < 1), beta, np.nan)
+        gamma_squared = 1 / (1 - beta**2)
+        momentum = mass * beta * np.sqrt(gamma_squared)
+        if tof_error is None:
+            return momentum
+        momentum_error = np.abs(momentum * gamma_squared / tof) * tof_error
+    return momentum, momentum_error
+
+
+@dataclass
+class MomentumResult:
+    """Class for storing the fit and momentum from a ToF histogram."""
+
+    n_events: int
+    coeff: np.ndarray  # comb_gauss params, (amp, mean, var) for e, mu, pi
+    covariance: np.ndarray  # covariance of coeff from the fit
+    offset_mean: float  # ns
+    offset_error: float  # standard error of offset_mean, ns
+    p_mu: float  # MeV/c
+    p_pi: float  # MeV/c
+    momentum: float  # average of p_mu and p_pi, MeV/c
+    p_mu_error: float
+    p_pi_error: float
+    momentum_error: float  # includes the offset they have in common
+
+    @property
+    def means(self):
+        """Return the fitted (e, mu, pi) ToF means, ns."""
+        return self.coeff[1], self.coeff[4], self.coeff[7]
+
+    @property
+    def real_tofs(self):
+        """Return the (mu, pi) ToFs with the offset taken away, ns."""
+        mu_mean, pi_mean = self.coeff[4], self.coeff[7]
+        return mu_mean - self.offset_mean, pi_mean - self.offset_mean
+
+    @property
+    def time_resolution(self):
+        """Return the electron peak width, ns (electrons all have beta~1)."""
+        return np.sqrt(self.coeff[2])
+
+
+def event_momenta(delta_t, result: MomentumResult, mass):
+    """
+    Return (momenta, errors) in MeV/c for an array of BC3-BC1 ToFs (ns).
+
+    Every event is assumed to be a particle with the given mass,
+    the error comes from the time resolution of the run.
+    """
+    return momentum_from_tof(delta_t - result.offset_mean, mass,
+                             result.time_resolution)
+
 
-    mask_e = mask*(delta_t > e_mean-2*e_sigma)*(delta_t < e_mean+2*e_sigma)
+def analyse(counts: TofCounts, poisson=False):
+    """Return the MomentumResult for some TofCounts (no plots).
+
+    poisson: bool, fit the ToF histogram with a Poisson likelihood
+    """
+    coeff, covariance = fit_tof(*tof_histogram(counts), poisson=poisson)
+    # offset should be the same for electrons, muons, and pions, use electrons
+    offset, weights, offset_mean = electron_offset(counts, coeff)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset_error = np.sqrt(
+            np.sum(weights * (offset - offset_mean)**2)) / np.sum(weights)
+    # our real ToFs (don't need electrons, it should be constant):
+    real_mu_tof = coeff[4] - offset_mean
+    real_pi_tof = coeff[7] - offset_mean
+    # momentum from each ToF, and dp/dt (the error for a 1 ns ToF error)
+    p_mu, dp_mu = momentum_from_tof(real_mu_tof, MUON_MASS, 1)
+    p_pi, dp_pi = momentum_from_tof(real_pi_tof, PION_MASS, 1)
+
+    # errors, from the fitted mu/pi means (and their covariance) and offset
+    means_covariance = covariance[np.ix_([4, 7], [4, 7])]
+    p_mu_error = dp_mu * np.sqrt(means_covariance[0, 0] + offset_error**2)
+    p_pi_error = dp_pi * np.sqrt(means_covariance[1, 1] + offset_error**2)
+    # the average depends on (mu mean, pi mean, offset)
+    gradient = np.array([dp_mu, dp_pi, -dp_mu - dp_pi]) / 2
+    all_covariance = np.zeros((3, 3))
+    all_covariance[:2, :2] = means_covariance
+    all_covariance[2, 2] = offset_error**2
+    momentum_error = np.sqrt(gradient @ all_covariance @ gradient)
+    return MomentumResult(
+        n_events=len(counts),
+        coeff=coeff,
+        covariance=covariance,
+        offset_mean=offset_mean,
+        offset_error=offset_error,
+        p_mu=float(p_mu),
+        p_pi=float(p_pi),
+        momentum=np.average([p_mu, p_pi]),
+        p_mu_error=float(p_mu_error),
+        p_pi_error=float(p_pi_error),
+        momentum_error=float(momentum_error),
+    )
+
+
+# plots made by calculate_momentum (see plotting.py):
+
+
+def plot_tof_hist(counts: TofCounts, result: MomentumResult):
+    """Plot the ToF histogram and fit, save as beam_tof_hist.png."""
+    plt = plotting.pyplot()
+    plt.rcParams.update({'font.size': 22})
+    coeff = result.coeff
+    delta_t = counts.delta_t
+    weights = counts.counts
+    mask = delta_t != 0
+    mask_e = electron_mask(delta_t, coeff)
+
+    # make a histogram
+    plt.figure(figsize=(12, 8))
+    plt.title('beam')
+    plt.xlabel('time-of-flight: BC3-BC1, ns')
+    plt.ylabel('counts')
+    _, bins, _ = plt.hist(
+        delta_t[mask], TOF_BINS, range=TOF_RANGE, weights=weights[mask],
+        histtype='step', lw=3)
+    centres = bin_centres(bins)
 
     # plot the fit histogram
-    plt.plot(bin_centres, fit_hist, c='k', lw=3, ls='--')
+    plt.plot(centres, comb_gauss(centres, *coeff), c='k', lw=3, ls='--')
 
     # plot individual Gaussians
-    plt.plot(bin_centres, gauss(bin_centres, *coeff[0:3]),
+    plt.plot(centres, gauss(centres, *coeff[0:3]),
              c='r', lw=3, ls=':',
              label=f'$e$: mean = {coeff[1]:.2f}')
-    plt.plot(bin_centres, gauss(bin_centres, *coeff[3:6]),
+    plt.plot(centres, gauss(centres, *coeff[3:6]),
              c='orange', lw=3, ls=':',
              label=f'$\\mu$: mean = {coeff[4]:.2f}')
-    plt.plot(bin_centres, gauss(bin_centres, *coeff[6:]),
+    plt.plot(centres, gauss(centres, *coeff[6:]),
              c='g', lw=3, ls=':',
              label=f'$\\pi$: mean = {coeff[7]:.2f}')
     # filled in bit for just the electrons
     plt.hist(delta_t[mask_e],
-             179, range=(-10, 8),
+             TOF_BINS, range=TOF_RANGE, weights=weights[mask_e],
              histtype='stepfilled', lw=3, alpha=0.2, color='r')
     # add legend, save
     plt.legend()
     plt.savefig("beam_tof_hist.png")
-    plt.cla()
-    plt.clf()
+    plt.close()
 
-    # now calculate the offset due to electronics etc
-    print("calculating offset")
-    # offset should be the same for electrons, muons, and pions, use electrons
-    delta_t_electrons = delta_t[mask_e]
-    # offset = time taken for electronics to do their thing
-    # we assume our particles are really travelling around speed of light, so
-    # to get the offset we take our measured time minus time light would take
-    offset = delta_t_electrons - length/c_m_per_ns
-    offset_mean = np.mean(offset)
-    plt.hist(offset, 100)
+
+def plot_offset(counts: TofCounts, result: MomentumResult):
+    """Plot the electron offsets, save as beam_e_offset_hist.png."""
+    plt = plotting.pyplot()
+    plt.rcParams.update({'font.size': 22})
+    offset, weights, offset_mean = electron_offset(counts, result.coeff)
+    plt.figure(figsize=(12, 8))
+    plt.hist(offset, 100, weights=weights)
     plt.axvline(offset_mean, c='k', lw=3)
     plt.xlabel(f"electron offset, ns -- mean = {offset_mean}")
     plt.ylabel("counts")
     plt.savefig("beam_e_offset_hist.png")
-    plt.cla()
-    plt.clf()
-
-    # for a given momentum we can calculate what our ToF should be
-    print("calculating expected ToF")
-    momentum = np.arange(50, 300, 1)  # MeV/c
-
-    def get_tof(mass):
-        """Get time of flight for a given mass at a bunch of different momenta.
-        Mass is in MeV.
-        """
-        e_total = np.sqrt(momentum**2 + mass**2)
-        beta = momentum / e_total
-        tof = length / (beta * c_m_per_ns)
-        return tof
-
-    electron_mass = 0.511  # MeV
-    muon_mass = 105.660  # MeV
-    pion_mass = 139.570  # MeV
-    calc_e_tof = get_tof(electron_mass)
-    calc_mu_tof = get_tof(muon_mass)
-    calc_pi_tof = get_tof(pion_mass)
-
-    # our real ToFs (don't need electrons, it should be constant):
-    real_mu_tof = m_mean - offset_mean
-    real_pi_tof = p_mean - offset_mean
-
-    # best match momentum = where real tof closest to calculated ToF
-    p_mu = momentum[np.argmin(abs(calc_mu_tof - real_mu_tof))]
-    p_pi = momentum[np.argmin(abs(calc_pi_tof - real_pi_tof))]
+    plt.close()
 
-    # value to return
-    avg_p = np.average([p_mu, p_pi])
-    print(f"Calculated beam momentum: {avg_p} MeV/c")
 
-    plt.plot(momentum, calc_e_tof, 'r', label="e")
-    plt.plot(momentum, calc_mu_tof, 'orange', label="mu")
-    plt.plot(momentum, calc_pi_tof, 'darkgreen', label="pi")
-    plt.plot([p_mu, p_pi], [real_mu_tof, real_pi_tof], 'ko')
+def plot_momentum(result: MomentumResult):
+    """Plot expected ToF vs momentum, save as beam_momentum_vs_tof.png."""
+    plt = plotting.pyplot()
+    plt.rcParams.update({'font.size': 22})
+    calc_e_tof = get_tof(ELECTRON_MASS)
+    calc_mu_tof = get_tof(MUON_MASS)
+    calc_pi_tof = get_tof(PION_MASS)
+    avg_p = result.momentum
+    plt.figure(figsize=(12, 8))
+    plt.plot(MOMENTA, calc_e_tof, 'r', label="e")
+    plt.plot(MOMENTA, calc_mu_tof, 'orange', label="mu")
+    plt.plot(MOMENTA, calc_pi_tof, 'darkgreen', label="pi")
+    plt.plot([result.p_mu, result.p_pi], result.real_tofs, 'ko')
     plt.plot([avg_p, avg_p], [min(calc_e_tof), max(calc_pi_tof)], 'k')
-    plt.title(f"Calculated beam momentum: {avg_p} MeV/c")
+    plt.title(f"Calculated beam momentum: {avg_p:.1f} "
+              f"$\\pm$ {result.momentum_error:.1f} MeV/c")
     plt.xlabel("Momentum, MeV/c")
     plt.ylabel("Time of flight, ns")
     plt.legend()
     plt.savefig("beam_momentum_vs_tof.png")
-    plt.cla()
-    plt.clf()
+    plt.close()
+
+
+# the main function to calculate beam momentum:
 
-    return avg_p
+
+def calculate_momentum(root_file_paths, step_size=midas_data.STEP_SIZE,
+                       poisson=False):
+    """given root file(s) from one momentum setting, calculate beam momentum
+
+    root_file_paths: path or list of paths, combined into one histogram
+    step_size: number of entries (or e.g. "100 MB") to read at a time
+    poisson: bool, fit the ToF histogram with a Poisson likelihood
+    """
+    # read the tdc data a chunk at a time, only keeping a count of each
+    # BC3-BC1 value (so memory doesn't depend on the number of events)
+    print("reading files, counting ToF values")
+    counts = tof_counts(root_file_paths, step_size)
+
+    print("fitting curves, calculating offset and momentum")
+    result = analyse(counts, poisson)
+    print(f"Calculated beam momentum: {result.momentum} "
+          f"+/- {result.momentum_error} MeV/c")
+
+    # these are made now, later or not at all depending on the plot mode
+    plotting.plot(plot_tof_hist, counts, result)
+    plotting.plot(plot_offset, counts, result)
+    plotting.plot(plot_momentum, result)
+
+    return result.momentum
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument(
-        "-f", dest="file", default=DEFAULT_ROOT_FILE_NAME,
-        help="path to root file with beam data")
+        "-f", dest="files", nargs="+", default=[DEFAULT_ROOT_FILE_NAME],
+        help="path to root file(s) with beam data, from one momentum setting")
+    parser.add_argument(
+        "--step-size", type=int, default=midas_data.STEP_SIZE,
+        help="number of entries to read at a time")
+    parser.add_argument(
+        "--poisson", action="store_true",
+        help="fit the ToF histogram with a Poisson likelihood")
+    parser.add_argument(
+        "--plots", choices=plotting.MODES, default=plotting.get_mode(),
+        help="make plots now (default), after the fit, in parallel, or never")
     args = parser.parse_args()
-    calculate_momentum(args.file)
+    plotting.set_mode(args.plots)
+    calculate_momentum(args.files, args.step_size, args.poisson)
+    plotting.render_pending()
@@ -0,0 +1,203 @@
+"""Module for storing Gaussian functions for fitting curves."""
+from dataclasses import dataclass
+import numpy as np
+
+
+def gauss(xvals, amp, mean, var):
+    """Return a Gaussian with the given x values and parameters.
+
+    xvals: numpy array of x values
+    amp: number, amplitude of Gaussian
+    mean: number, mean of Gaussian
+    var: variance of Gaussian
+    """
+    return amp*np.exp(-(xvals-mean)**2/(2*var))
+
+
+def comb_gauss(xvals, *params):
+    """Return a sum of Gaussians.
+
+    xvals: numpy array of x values
+    params: list of parameters to pass, must have length being a multiple of 3
+            (amplitude, mean, variance) for each Gaussian
+    """
+    assert len(params) % 3 == 0
+    distr = 0
+    for j in range(len(params) // 3):
+        distr += gauss(xvals, *[params[j*3], params[j*3+1], params[j*3+2]])
+    return distr
+
+
+@dataclass
+class GaussFit:
+    """Class for storing the result of a MultiGauss fit."""
+
+    params: np.ndarray  # (amplitude, mean, variance) for each Gaussian
+    covariance: np.ndarray
+    n_evaluations: int  # number of times the model was evaluated
+
+    @property
+    def errors(self):
+        """Return the errors on params, from the covariance."""
+        return np.sqrt(np.diag(self.covariance))
+
+    @property
+    def means(self):
+        """Return the mean of each Gaussian."""
+        return self.params[1::3]
+
+    @property
+    def variances(self):
+        """Return the variance of each Gaussian."""
+        return self.params[2::3]
+
+
+class MultiGauss():
+    """
+    Class for a sum of n Gaussians, with parameters in comb_gauss order.
+
+    All the Gaussians are evaluated at once as an (x values x n) array,
+    and the Jacobian is calculated analytically, so fits need fewer model
+    evaluations than curve_fit with numerical derivatives. Variances are
+    kept positive while fitting.
+
+    Example:
+        model = MultiGauss(3)
+        fit = model.fit(bin_centres, hist, p0=[4000, -5, 1, ...])
+        fit = model.fit(bin_centres, hist, p0=..., poisson=True)
+        model(bin_centres, *fit.params)  # same as comb_gauss
+    """
+
+    def __init__(self, n_gaussians):
+        """Make a model with n_gaussians Gaussians (3 params each)."""
+        self.n_gaussians = n_gaussians
+
+    def _split(self, params):
+        """Return (amplitudes, means, variances) arrays from params."""
+        params = np.asarray(params, dtype=float)
+        if params.shape != (3*self.n_gaussians,):
+            raise ValueError(f"expected {3*self.n_gaussians} parameters, "
+                             f"got {params.size}")
+        return params[0::3], params[1::3], params[2::3]
+
+    def components(self, xvals, *params):
+        """Return each Gaussian, as an (x values x n_gaussians) array."""
+        amps, means, variances = self._split(params)
+        xvals = np.asarray(xvals, dtype=float)[..., None]
+        return amps*np.exp(-(xvals-means)**2/(2*variances))
+
+    def __call__(self, xvals, *params):
+        """Return the sum of the Gaussians, like comb_gauss."""
+        return self.components(xvals, *params).sum(axis=-1)
+
+    def jacobian(self, xvals, *params):
+        """Return d(model)/d(params), an (x values x params) array."""
+        amps, means, variances = self._split(params)
+        diff = np.asarray(xvals, dtype=float)[:, None] - means
+        shape = np.exp(-diff**2/(2*variances))
+        jac = np.empty((len(diff), 3*self.n_gaussians))
+        jac[:, 0::3] = shape
+        jac[:, 1::3] = amps*shape*diff/variances
+        jac[:, 2::3] = amps*shape*diff**2/(2*variances**2)
+        return jac
+
+    def lower_bounds(self, poisson=False):
+        """Return lower bounds on the params (amplitudes >= 0 if poisson)."""
+        lower = np.full(3*self.n_gaussians, -np.inf)
+        lower[2::3] = 0
+        if poisson:
+            lower[0::3] = 0
+        return lower
+
+    def fit(self, xvals, counts, p0, background=0, poisson=False, **kwargs):
+        """
+        Fit the Gaussians (plus a fixed background) to some counts.
+
+        xvals, counts: arrays, e.g. bin centres and histogram counts
+        p0: initial guesses, in comb_gauss order
+        background: number or array, fixed background under the peaks
+        poisson: bool, use a binned Poisson likelihood (good for bins with
+                 low counts) instead of least squares
+        kwargs: passed to fit_least_squares or fit_poisson
+        """
+        if poisson:
+            return self.fit_poisson(xvals, counts, p0, background, **kwargs)
+        return self.fit_least_squares(xvals, counts, p0, background,
+                                      **kwargs)
+
+    def fit_least_squares(self, xvals, counts, p0, background=0, sigma=None):
+        """Fit with curve_fit, using the analytic Jacobian. See fit."""
+        from scipy.optimize import curve_fit  # slow to import, only here
+        params, covariance, info, *_ = curve_fit(
+            self, xvals, np.asarray(counts) - background, p0=p0,
+            sigma=sigma, jac=self.jacobian, full_output=True,
+            # scale steps by the Jacobian, amplitudes >> means >> variances
+            bounds=(self.lower_bounds(), np.inf), x_scale='jac')
+        return GaussFit(params, covariance, info["nfev"])
+
+    def negative_log_likelihood(self, xvals, counts, params, background=0):
+        """Return the Poisson -log(likelihood) (without constant terms)."""
+        expected = background + self(xvals, *params)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_terms = np.where(counts > 0, counts*np.log(expected), 0)
+        value = np.sum(expected - log_terms)
+        return value if np.isfinite(value) else np.inf
+
+    def fit_poisson(self, xvals, counts, p0, background=0,
+                    max_iterations=200, tolerance=1e-10):
+        """
+        Fit by minimising the Poisson -log(likelihood) of binned counts.
+
+        Expected counts are background + Gaussians, so counts should not
+        have the background subtracted. Steps are Levenberg-Marquardt damped
+        Fisher scoring with the analytic Jacobian, and the covariance is the
+        inverse of the Fisher information at the best fit.
+        """
+        xvals = np.asarray(xvals, dtype=float)
+        counts = np.asarray(counts, dtype=float)
+        lower = self.lower_bounds(poisson=True)
+        params = np.array(p0, dtype=float)
+        value = self.negative_log_likelihood(xvals, counts, params,
+                                             background)
+        if not np.isfinite(value):
+            raise ValueError("initial guess gives expected counts <= 0 "
+                             "where there are counts")
+        damping = 1e-3
+        n_evaluations = 1
+        for _ in range(max_iterations):
+            expected = background + self(xvals, *params)
+            weights = 1 / np.maximum(expected, np.finfo(float).tiny)
+            jac = self.jacobian(xvals, *params)
+            gradient = jac.T @ ((counts - expected) * weights)
+            information = jac.T @ (jac * weights[:, None])
+            # increase the damping until a step makes the fit better
+            while damping < 1e10:
+                damped = information + damping*np.diag(np.diag(information))
+                try:
+                    new_params = params + np.linalg.solve(damped, gradient)
+                except np.linalg.LinAlgError:
+                    new_params = params
+                new_value = np.inf
+                if np.all(new_params > lower):
+                    new_value = self.negative_log_likelihood(
+                        xvals, counts, new_params, background)
+                    n_evaluations += 1
+                if new_value <= value:
+                    break
+                damping *= 10
+            else:
+                break  # no step makes it better, so we're at the minimum
+            improvement = value - new_value
+            params, value = new_params, new_value
+            damping = max(damping / 10, 1e-12)
+            if improvement <= tolerance * (abs(value) + tolerance):
+                break
+        expected = background + self(xvals, *params)
+        jac = self.jacobian(xvals, *params)
+        information = jac.T @ (
+            jac / np.maximum(expected, np.finfo(float).tiny)[:, None])
+        try:
+            covariance = np.linalg.inv(information)
+        except np.linalg.LinAlgError:
+            covariance = np.full_like(information, np.inf)
+        return GaussFit(params, covariance, n_evaluations)
@@ -0,0 +1,144 @@
+"""
+Module for loading ADC/TDC data from MIDAS root files.
+
+Each branch is converted to one 2D numpy array (events x channels) with
+awkward, instead of looping over events in python. Columns for each
+detector are available as named views:
+- BC1/2/3 = Scintillator number 1/2/3
+- C2/3/4/5/6 = PMT number 2/3/4/5/6
+
+Example:
+    data = load("output_000496.root")
+    data.adc_data["C2"]  # ADC values of PMT 2 for every event
+    delta_t = data.tdc_data["BC3"] - data.tdc_data["BC1"]
+
+    # big runs (or several files) a chunk at a time, only reading the TDC
+    for chunk in iterate(["a.root", "b.root"], branches=["tdc_value"]):
+        ...
+"""
+from dataclasses import dataclass
+import awkward as ak
+import numpy as np
+import uproot
+
+TREE_NAME = "midas_data"
+BRANCHES = ["adc_value", "tdc_value"]
+STEP_SIZE = 100000  # entries per chunk in iterate
+
+# which column of each branch belongs to which detector
+ADC_CHANNELS = {'BC1': 0, 'BC2': 1, 'BC3': 2,
+                'C2': 3, 'C3': 4, 'C4': 5, 'C5': 6, 'C6': 7}
+TDC_CHANNELS = {'BC1': 1, 'BC2': 2, 'BC3': 3}
+
+
+def to_2d(branch_array, width=None):
+    """
+    Convert an awkward array (maybe jagged) to an (events x width) array.
+
+    Short rows are padded with zeros, long rows are cut at width, and the
+    dtype of the branch (e.g. int32) is kept.
+    width: number of columns, default = length of the longest row
+    """
+    if branch_array.ndim == 1:
+        return ak.to_numpy(branch_array)
+    lengths = ak.to_numpy(ak.num(branch_array))
+    if width is None:
+        width = int(lengths.max(initial=0))
+    values = ak.to_numpy(ak.flatten(branch_array))
+    if len(lengths) and np.all(lengths == width):
+        return values.reshape(len(lengths), width)
+    # put each value at (its event, its index in the event)
+    events = np.repeat(np.arange(len(lengths)), lengths)
+    columns = ak.to_numpy(ak.flatten(ak.local_index(branch_array)))
+    keep = columns < width
+    padded = np.zeros((len(lengths), width), dtype=values.dtype)
+    padded[events[keep], columns[keep]] = values[keep]
+    return padded
+
+
+@dataclass
+class MidasData:
+    """Class for storing ADC/TDC data as (events x channels) arrays."""
+
+    adc: np.ndarray  # None if the adc_value branch wasn't read
+    tdc: np.ndarray  # None if the tdc_value branch wasn't read
+
+    @property
+    def adc_data(self):
+        """Dict of ADC columns (views, not copies) with detector keys."""
+        return {name: self.adc[:, column]
+                for name, column in ADC_CHANNELS.items()}
+
+    @property
+    def tdc_data(self):
+        """Dict of TDC columns (views, not copies) with detector keys."""
+        return {name: self.tdc[:, column]
+                for name, column in TDC_CHANNELS.items()}
+
+    def __len__(self):
+        """Return the number of events."""
+        return len(self.tdc if self.tdc is not None else self.adc)
+
+
+def branch_2d(arrays, branch, channels, source="data"):
+    """
+    Return a branch as a 2D array with the columns in channels, or None.
+
+    channels: ADC_CHANNELS or TDC_CHANNELS
+    source: what the arrays came from (a file name), for the error
+    Raises ValueError if the branch has too few columns for channels,
+    instead of an IndexError when the named views are made.
+    """
+    if branch not in arrays.fields:
+        return None
+    array = to_2d(arrays[branch])
+    needed = max(channels.values()) + 1
+    width = array.shape[1] if array.ndim == 2 else 1
+    if width < needed:
+        if len(array) == 0:
+            return np.zeros((0, needed), dtype=array.dtype)
+        raise ValueError(
+            f"{source}: {branch} has {width} columns, but "
+            f"{needed} are needed for {', '.join(channels)}")
+    return array
+
+
+def from_arrays(arrays, source="data"):
+    """
+    Return MidasData from an awkward record array of branches.
+
+    source: what the arrays came from (a file name), for errors
+    """
+    return MidasData(
+        adc=branch_2d(arrays, "adc_value", ADC_CHANNELS, source),
+        tdc=branch_2d(arrays, "tdc_value", TDC_CHANNELS, source))
+
+
+def load(root_file_path, entry_start=0, entry_stop=None, branches=BRANCHES):
+    """Return MidasData with all events (or a range of them) in a file."""
+    with uproot.open(root_file_path) as root_file:
+        arrays = root_file[TREE_NAME].arrays(
+            branches, library="ak",
+            entry_start=entry_start, entry_stop=entry_stop)
+    return from_arrays(arrays, root_file_path)
+
+
+def iterate(root_file_paths, step_size=STEP_SIZE, branches=BRANCHES):
+    """
+    Yield MidasData chunks of (at most) step_size events.
+
+    Only one chunk is in memory at a time, so this works for runs that
+    are bigger than RAM.
+    root_file_paths: path or list of paths, read one after another
+    step_size: number of entries, or a size like "100 MB"
+    branches: which branches to read (others are None in the chunks)
+    """
+    if isinstance(root_file_paths, str):
+        root_file_paths = [root_file_paths]
+    files = {path: TREE_NAME for path in root_file_paths}
+    for arrays, report in uproot.iterate(files, branches,
+                                         step_size=step_size, library="ak",
+                                         report=True):
+        source = (f"{report.file_path} "
+                  f"(entries {report.start}-{report.stop})")
+        yield from_arrays(arrays, source)
@@ -0,0 +1,157 @@
+"""
+Module for selecting tracks and calculating drift velocities.
+
+This does what `lastDistance`, `GetMeanLastChannel` and `GetDriftTime`
+in PathReconstruction.ipynb do, but for all events at once, using the
+(n_events x 32) times/amps arrays from read_processed_data.load.
+Track properties are calculated once, then cuts are just comparisons,
+so it's cheap to try lots of different cut values.
+
+Example:
+    events = rpd.load("analysis/output_1500.txt")
+    tracks = track_properties(events.times, events.amps)
+    speed, error, speeds = drift_velocity(tracks, min_time_variance=800)
+
+    # only fairly straight tracks
+    fit = track_fit.fit_tracks(events.times, events.amps)
+    speed, error, speeds = drift_velocity(tracks, mask=fit.residual < 10000)
+"""
+from dataclasses import dataclass
+import numpy as np
+
+# the source is mounted on a movable arm, 58.5mm from the GEM and 53mm to
+# the cathode plane, anode strips are 3mm wide and 3.125mm apart
+DIST_TO_GEM = 58.8/1e3  # m
+DIST_TO_CATHODE = 53/1e3  # m
+DIST_BETWEEN_ANODES = (3.125+3)/1e3  # m
+
+# 62.5 MHz for data taking freq. -> times need to be multiplied by this
+DT_DATA = 1/(62.5e6)  # s
+
+NO_GAP = 100  # last_gap for events with 2 or fewer hits
+
+
+@dataclass
+class Tracks:
+    """Class for storing track properties, one entry per event."""
+
+    n_hits: np.ndarray  # number of channels with a (non-zero) time
+    first_time: np.ndarray  # time in the first channel with a hit
+    last_time: np.ndarray  # time in the last channel with a hit
+    min_time: np.ndarray
+    max_time: np.ndarray
+    last_channel: np.ndarray  # -1 if no hits
+    last_gap: np.ndarray  # channels between the last 2 hits, see last_gap
+    time_variance: np.ndarray  # variance of the hit times, nan if no hits
+    mean_amp: np.ndarray  # mean amplitude over all channels
+
+    @property
+    def going_up(self):
+        """Mask of tracks with an earlier time in the last hit channel."""
+        return self.last_time < self.first_time
+
+    @property
+    def drift_speed(self):
+        """Drift speed in m/s, DIST_TO_GEM / (max - min hit time)."""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return DIST_TO_GEM / ((self.max_time - self.min_time) * DT_DATA)
+
+
+def _last_index(mask):
+    """Return the index of the last True in each row, -1 if none."""
+    n_columns = mask.shape[1]
+    last = n_columns - 1 - np.argmax(mask[:, ::-1], axis=1)
+    return np.where(mask.any(axis=1), last, -1)
+
+
+def _first_index(mask):
+    """Return the index of the first True in each row, -1 if none."""
+    return np.where(mask.any(axis=1), np.argmax(mask, axis=1), -1)
+
+
+def last_gap(times):
+    """
+    Return the number of channels between the last two hits (times > 0).
+
+    For events with 2 or fewer hits, NO_GAP is returned
+    (like `lastDistance` in the notebook).
+    """
+    positive = times > 0
+    last = _last_index(positive)
+    before_last = positive.copy()
+    before_last[np.arange(len(times)), last] = False
+    gap = last - _last_index(before_last)
+    return np.where(positive.sum(axis=1) > 2, gap, NO_GAP)
+
+
+def track_properties(times, amps):
+    """Return Tracks for (n_events x 32) arrays of hit times and amplitudes."""
+    hits = times != 0
+    n_hits = hits.sum(axis=1)
+    rows = np.arange(len(times))
+    first = _first_index(hits)
+    last = _last_index(hits)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_time = np.where(hits, times, 0).sum(axis=1) / n_hits
+        deviation = np.where(hits, times - mean_time[:, None], 0)
+        time_variance = (deviation**2).sum(axis=1) / n_hits
+    return Tracks(
+        n_hits=n_hits,
+        first_time=np.where(first >= 0, times[rows, first], np.nan),
+        last_time=np.where(last >= 0, times[rows, last], np.nan),
+        min_time=np.where(hits, times, np.inf).min(axis=1),
+        max_time=np.where(hits, times, -np.inf).max(axis=1),
+        last_channel=last,
+        last_gap=last_gap(times),
+        time_variance=time_variance,
+        mean_amp=amps.mean(axis=1),
+    )
+
+
+def good_tracks(tracks: Tracks, max_last_gap=2, min_time_variance=100,
+                min_mean_amp=0):
+    """
+    Return a mask of events passing the basic cuts.
+
+    max_last_gap: last two hits must be closer than this
+                  (removes signals with strange bumps in them)
+    min_time_variance: hit times must vary more than this (not horizontal)
+    min_mean_amp: mean amplitude must be more than this
+    """
+    return ((tracks.last_gap < max_last_gap)
+            & (tracks.time_variance > min_time_variance)
+            & (tracks.mean_amp > min_mean_amp))
+
+
+def mean_last_channel(tracks: Tracks, max_last_gap=2, min_time_variance=100,
+                      min_mean_amp=0):
+    """Return the mean last hit channel of good tracks, rounded."""
+    mask = good_tracks(tracks, max_last_gap, min_time_variance, min_mean_amp)
+    return np.round(np.mean(tracks.last_channel[mask]))
+
+
+def drift_velocity(tracks: Tracks, max_last_gap=2, min_time_variance=500,
+                   min_mean_amp=0, going_up=True,
+                   last_channel_time_variance=100, mask=None):
+    """
+    Return (mean drift speed, error, drift speeds of selected tracks), m/s.
+
+    Tracks are selected like in `GetDriftTime`: good_tracks with the given
+    cuts, going up (if going_up), and with last_gap less than the
+    mean_last_channel (calculated with last_channel_time_variance).
+    mask: optional extra mask of events to use, e.g. a cut on the
+          residual from track_fit.fit_tracks
+    The error is sqrt(number of selected tracks).
+    """
+    mean_channel = mean_last_channel(
+        tracks, max_last_gap, last_channel_time_variance, min_mean_amp)
+    selected = good_tracks(
+        tracks, max_last_gap, min_time_variance, min_mean_amp)
+    selected &= tracks.last_gap < mean_channel
+    if going_up:
+        selected &= tracks.going_up
+    if mask is not None:
+        selected &= mask
+    speeds = tracks.drift_speed[selected]
+    speeds = speeds[speeds != np.inf]
+    return np.mean(speeds), np.sqrt(len(speeds)), speeds
@@ -0,0 +1,119 @@
+"""
+Module for getting the drift velocity at many cathode voltages in one go.
+
+Output files are named like analysis/output_<voltage>.txt (anything after
+the voltage, like output_1500_pushed_in.txt, is kept as a label).
+Each file is loaded and analysed with drift.py in a pool of processes.
+
+Example:
+    python drift_scan.py "analysis/output_*.txt" -j 4
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import glob
+import os
+import re
+import timeit
+import numpy as np
+
+import read_processed_data as rpd
+import drift
+
+VOLTAGE_PATTERN = re.compile(r"output_(\d+)_?(.*)\.txt$")
+
+
+@dataclass
+class ScanResult:
+    """Class for storing the drift velocity result from one file."""
+
+    filename: str
+    voltage: int  # cathode voltage
+    label: str  # whatever came after the voltage in the file name
+    n_events: int
+    n_selected: int  # number of tracks used for the drift speed
+    mean_speed: float  # m/s
+    spread: float  # standard deviation of the drift speeds, m/s
+    error: float  # sqrt(n_selected), like GetDriftTime
+    load_seconds: float
+    analysis_seconds: float
+
+
+def parse_voltage(filename):
+    """Return (voltage, label) from a file name like output_1500.txt."""
+    match = VOLTAGE_PATTERN.search(os.path.basename(filename))
+    if match is None:
+        raise ValueError(f"no voltage in file name: {filename}")
+    return int(match.group(1)), match.group(2)
+
+
+def analyse_file(filename, **cuts):
+    """Load one output file and return its ScanResult, cuts go to drift."""
+    voltage, label = parse_voltage(filename)
+    start = timeit.default_timer()
+    events = rpd.load(filename)
+    loaded = timeit.default_timer()
+    tracks = drift.track_properties(events.times, events.amps)
+    mean_speed, error, speeds = drift.drift_velocity(tracks, **cuts)
+    done = timeit.default_timer()
+    return ScanResult(
+        filename=filename,
+        voltage=voltage,
+        label=label,
+        n_events=len(events),
+        n_selected=len(speeds),
+        mean_speed=mean_speed,
+        spread=np.std(speeds),
+        error=error,
+        load_seconds=loaded - start,
+        analysis_seconds=done - loaded,
+    )
+
+
+def scan(patterns, workers=None, **cuts):
+    """
+    Return a list of ScanResults (sorted by voltage) for all matching files.
+
+    patterns: glob pattern or list of them, e.g. "analysis/output_*.txt"
+    workers: number of processes, default = number of cores
+    cuts: passed on to drift.drift_velocity, e.g. min_time_variance=800
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    filenames = sorted({name for pattern in patterns
+                        for name in glob.glob(pattern)})
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(analyse_file, name, **cuts)
+                   for name in filenames]
+        results = [future.result() for future in futures]
+    return sorted(results, key=lambda result: (result.voltage, result.label))
+
+
+def print_table(results):
+    """Print ScanResults as a table."""
+    print(f"{'voltage':>8} {'label':>10} {'events':>7} {'tracks':>7} "
+          f"{'speed [m/s]':>12} {'spread':>10} {'error':>7} "
+          f"{'load [s]':>9} {'fit [s]':>8}")
+    for res in results:
+        print(f"{res.voltage:8d} {res.label:>10} {res.n_events:7d} "
+              f"{res.n_selected:7d} {res.mean_speed:12.1f} {res.spread:10.1f} "
+              f"{res.error:7.1f} {res.load_seconds:9.3f} "
+              f"{res.analysis_seconds:8.3f}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "patterns", nargs="+",
+        help="output files or glob patterns, e.g. 'analysis/output_*.txt'")
+    parser.add_argument(
+        "-j", dest="workers", type=int, default=None,
+        help="number of worker processes (default: number of cores)")
+    parser.add_argument(
+        "--min-time-variance", type=float, default=500,
+        help="minimum variance of hit times for a track to be used")
+    args = parser.parse_args()
+    start_time = timeit.default_timer()
+    print_table(scan(args.patterns, workers=args.workers,
+                     min_time_variance=args.min_time_variance))
+    print(f"total time: {timeit.default_timer() - start_time:.2f} s")
@@ -6,37 +6,108 @@ on the laptop from the TACTIC lab.
 """
 
 from dataclasses import dataclass
-from typing import List
+import os
 import numpy as np
 import matplotlib.pyplot as plt
 
 
+N_CHANNELS = 32
+
+
 @dataclass
 class Event:
     """for storing data from `process` output files"""
     times: np.ndarray
     amps: np.ndarray
     number: int
-    channels = np.array(list(range(32)))
+    channels = np.array(list(range(N_CHANNELS)))
     
 
+def _read_only(row):
+    """Return a view of row that can't be written to."""
+    view = row.view()
+    view.flags.writeable = False
+    return view
+
+
+class EventStore():
+    """
+    Class for all the events from a `process` output file.
+
+    times and amps are (n_events x 32) arrays, indexing or iterating gives
+    Event objects that are just read-only views of one row (made when
+    asked for), and a slice gives a list of them.
+    """
+
+    def __init__(self, times: np.ndarray, amps: np.ndarray):
+        """Create object from (n_events x 32) arrays of times and amps."""
+        self.times = times
+        self.amps = amps
+
+    def __len__(self):
+        """Return the number of events."""
+        return len(self.times)
+
+    def __getitem__(self, event_num):
+        """Return an Event for row event_num, or a list for a slice."""
+        if isinstance(event_num, slice):
+            return [self[num] for num in range(len(self))[event_num]]
+        if event_num < 0:
+            event_num += len(self)
+        if not 0 <= event_num < len(self):
+            raise IndexError(f"event {event_num} out of range")
+        return Event(_read_only(self.times[event_num]),
+                     _read_only(self.amps[event_num]), event_num)
+
+    def __iter__(self):
+        """Iterate over Events."""
+        for event_num in range(len(self)):
+            yield self[event_num]
+
+
+def cache_filename(filename):
+    """Return the name of the .npz cache for an output file."""
+    return os.path.splitext(filename)[0] + ".npz"
+
+
+def load(filename, cache=False):
+    """
+    Read an output file generated by the `process` script into an EventStore.
+
+    The whole file is converted to numbers at once. If cache is True,
+    the arrays are saved in a .npz file next to the output file,
+    and read from there next time (unless the output file is newer).
+    """
+    npz_filename = cache_filename(filename)
+    if (cache and os.path.exists(npz_filename)
+            and os.path.getmtime(npz_filename) >= os.path.getmtime(filename)):
+        with np.load(npz_filename) as arrays:
+            return EventStore(arrays["times"], arrays["amps"])
+
+    words = np.loadtxt(filename, ndmin=2, encoding="utf-8")
+    if words.size and words.shape[1] != N_CHANNELS * 2:
+        # 32 channels, time and amplitude on every line
+        raise ValueError(
+            f"{filename}: expected {N_CHANNELS*2} numbers on every line")
+    words = words.reshape(-1, N_CHANNELS * 2)
+    times = np.ascontiguousarray(words[:, 0::2])
+    amps = np.ascontiguousarray(words[:, 1::2])
+    if cache:
+        np.savez(npz_filename, times=times, amps=amps)
+    return EventStore(times, amps)
+
+
 def read(filename):
     """
     Read output.txt files generated by the `process` script.
 
     Each line in the file is of the form 'time voltage time voltage ....'
     for all the channels (channel = strip number, not digitizer channel)
+
+    Returns an EventStore, which can be used like a list of Events.
     """
-    with open(filename, "r+", encoding="utf-8") as peak_file:
-        lines = peak_file.readlines()
-    events: List[Event] = []
-    for event_num, event_line in enumerate(lines):
-        words = list(map(float, event_line.split()))
-        assert len(words) == 32*2  # 32 channels, time and amplitude
-        times = np.array(words[0::2])
-        amplitudes = np.array(words[1::2])
-        events.append(Event(times, amplitudes, event_num))
-    return events
+    return load(filename)
+
 
 if __name__ == "__main__":
     events = read("analysis/output_1100.txt")
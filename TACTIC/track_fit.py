@@ -0,0 +1,82 @@
+"""
+Module for fitting straight lines (time vs channel) to all tracks at once.
+
+PathReconstruction.ipynb fits each event with np.polyfit(..., 1, full=True),
+this does the same least squares fit for every event in one go using the
+(n_events x 32) times/amps arrays from read_processed_data.load.
+
+Example:
+    events = rpd.load("analysis/output_1500.txt")
+    fit = fit_tracks(events.times, events.amps)
+    straight = fit.residual < 10000
+"""
+from dataclasses import dataclass
+import numpy as np
+
+N_CHANNELS = 32
+
+
+@dataclass
+class TrackFit:
+    """Class for storing fit results, time = slope*channel + intercept."""
+
+    slope: np.ndarray
+    intercept: np.ndarray
+    residual: np.ndarray  # weighted sum of squared residuals
+    covariance: np.ndarray  # (n_events x 2 x 2), order is (slope, intercept)
+    n_points: np.ndarray  # number of hits used in each fit
+
+    @property
+    def errors(self):
+        """Return (slope error, intercept error) from the covariance."""
+        return (np.sqrt(self.covariance[:, 0, 0]),
+                np.sqrt(self.covariance[:, 1, 1]))
+
+
+def fit_tracks(times, amps=None, mask=None, weighted=False,
+               channels=np.arange(N_CHANNELS)):
+    """
+    Fit time = slope*channel + intercept to the hits of every event.
+
+    times, amps: (n_events x 32) arrays
+    mask: which hits to use, default is all non-zero times
+    weighted: bool, weight each hit by its amplitude (hits with amplitude
+              <= 0 are left out), same as np.polyfit with w=sqrt(amps)
+    channels: channel number of each column
+
+    Results are the same as np.polyfit(channels, times, 1, full=True) and
+    (cov=True) for each event. With 2 points the residual and covariance
+    are nan, with less than 2 everything is nan.
+    """
+    if mask is None:
+        mask = times != 0
+    weights = mask.astype(float)
+    if weighted:
+        weights *= np.clip(amps, 0, None)
+    x = np.broadcast_to(channels, times.shape)
+    y = np.where(mask, times, 0)
+
+    # sums for the normal equations
+    s = weights.sum(axis=1)
+    s_x = (weights * x).sum(axis=1)
+    s_y = (weights * y).sum(axis=1)
+    s_xx = (weights * x * x).sum(axis=1)
+    s_xy = (weights * x * y).sum(axis=1)
+    n_points = (weights > 0).sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        det = s * s_xx - s_x**2
+        slope = (s * s_xy - s_x * s_y) / det
+        intercept = (s_xx * s_y - s_x * s_xy) / det
+        fit_line = slope[:, None] * x + intercept[:, None]
+        residual = (weights * (y - fit_line)**2).sum(axis=1)
+        residual[n_points <= 2] = np.nan
+        # inverse of [[s_xx, s_x], [s_x, s]] scaled like np.polyfit does
+        scale = residual / (n_points - 2) / det
+        covariance = np.empty((len(times), 2, 2))
+        covariance[:, 0, 0] = s * scale
+        covariance[:, 0, 1] = covariance[:, 1, 0] = -s_x * scale
+        covariance[:, 1, 1] = s_xx * scale
+    invalid = n_points < 2
+    slope[invalid] = intercept[invalid] = np.nan
+    return TrackFit(slope, intercept, residual, covariance, n_points)
@@ -0,0 +1,211 @@
+"""
+Module for reading single events from all the wave<n>.txt files of a run.
+
+The first time a wave<n>.txt file is opened, the byte offset of every
+"Record" line is found and saved next to it in wave<n>.offsets.npy.
+After that, getting event k just means seeking to offsets[k] in each file,
+so paging through event displays doesn't need to read whole files.
+If a file has been converted with wavecache.py, the cache is used instead.
+
+Example:
+    reader = EventReader("raw_waves_1500")
+    strips = reader[10000]  # (strip x sample) array, already rearranged
+"""
+import os
+import numpy as np
+
+from waveforms import RECORD_MARKER, parse_samples, record_layout
+from wavecache import WaveCache, convert, has_cache
+
+# strip number for each digitizer channel
+CABLING_MAP = np.array([
+    2, 18, 3, 19, 4, 20, 5, 21, 6, 22, 7, 23, 8, 24, 9,
+    25, 10, 26, 11, 27, 12, 28, 13, 29, 14, 30, 15, 31, 16, 32]) - 3
+N_CHANNELS = len(CABLING_MAP)  # digitizer channels we read out
+DEAD_STRIP = 14  # this strip isn't in the rearranged waveforms
+
+OFFSETS_SUFFIX = ".offsets.npy"
+BLOCK_SIZE = 2**24  # bytes to read at once when finding offsets
+
+
+def _strip_channels():
+    """
+    Return the digitizer channel that ends up in each strip.
+
+    This is the loop from tactic_ana.ipynb, run once on channel numbers
+    instead of on waveforms. Note CABLING_MAP[0] is -1, so channel 0 goes
+    to the last strip and is then overwritten by channel 29 (and no channel
+    is mapped to DEAD_STRIP). This is kept the way the notebook did it.
+    """
+    strip_channels = np.zeros(N_CHANNELS - 1, dtype=int)
+    for channel, strip in enumerate(CABLING_MAP):
+        if strip == DEAD_STRIP:
+            continue
+        strip_channels[strip - (1 if strip > DEAD_STRIP else 0)] = channel
+    return strip_channels
+
+
+STRIP_CHANNELS = _strip_channels()  # digitizer channel for each strip
+
+
+def remap(waveforms):
+    """
+    Rearrange a (channel x sample) array of waveforms into strip order,
+    (strip x sample), using CABLING_MAP and leaving out DEAD_STRIP.
+    """
+    return waveforms[STRIP_CHANNELS]
+
+
+def find_offsets(wave_filename):
+    """Return the byte offsets of all the records in a wave<n>.txt file."""
+    offsets = []
+    position = 0  # position of block in the file
+    tail = b""  # end of the previous block, in case a marker is split
+    with open(wave_filename, "rb") as wave_file:
+        while True:
+            block = wave_file.read(BLOCK_SIZE)
+            if not block:
+                break
+            data = tail + block
+            start = position - len(tail)
+            i = data.find(RECORD_MARKER)
+            while i >= 0:
+                offsets.append(start + i)
+                i = data.find(RECORD_MARKER, i + 1)
+            position += len(block)
+            tail = data[-(len(RECORD_MARKER) - 1):]
+    return np.array(offsets, dtype=np.int64)
+
+
+def load_offsets(wave_filename):
+    """Return the record offsets of a wave file, finding them if needed."""
+    offsets_path = os.path.splitext(wave_filename)[0] + OFFSETS_SUFFIX
+    if (os.path.exists(offsets_path) and os.path.getmtime(offsets_path)
+            >= os.path.getmtime(wave_filename)):
+        return np.load(offsets_path)
+    offsets = find_offsets(wave_filename)
+    np.save(offsets_path, offsets)
+    return offsets
+
+
+class WaveFile():
+    """Class for reading single records from a wave<n>.txt file."""
+
+    def __init__(self, wave_filename):
+        """Open wave_filename, and find record offsets if not done yet."""
+        self.filename = wave_filename
+        self.offsets = load_offsets(wave_filename)
+        self.size = os.path.getsize(wave_filename)
+        with open(wave_filename, "rb") as wave_file:
+            self.header_lines, self.samples, _ = record_layout(wave_file)
+
+    def __len__(self):
+        """Return the number of records."""
+        return len(self.offsets)
+
+    def __getitem__(self, k):
+        """Return the waveform of record k."""
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError(f"record {k} out of range ({len(self)} records)")
+        stop = self.offsets[k+1] if k+1 < len(self) else self.size
+        with open(self.filename, "rb") as wave_file:
+            wave_file.seek(self.offsets[k] + len(RECORD_MARKER))
+            record = wave_file.read(stop - wave_file.tell())
+        return parse_samples([record], self.header_lines, self.samples)[0]
+
+
+class EventReader():
+    """Class for reading events (all channels) from a run directory."""
+
+    def __init__(self, directory, channels=range(N_CHANNELS)):
+        """
+        Open the wave<n>.txt files (or their caches) in directory.
+
+        channels: digitizer channels to read, the default (all of them)
+                  is needed to rearrange events with CABLING_MAP
+        """
+        self.channels = list(channels)
+        self.files = []
+        for n in self.channels:
+            filename = os.path.join(directory, f"wave{n}.txt")
+            if has_cache(filename):
+                self.files.append(WaveCache(filename))
+            else:
+                self.files.append(WaveFile(filename))
+
+    def __len__(self):
+        """Return the number of events (in all channels)."""
+        return min(len(wave_file) for wave_file in self.files)
+
+    def read_event(self, k):
+        """Return event k as a (channel x sample) array, no rearranging."""
+        return np.array([wave_file[k] for wave_file in self.files])
+
+    def __getitem__(self, k):
+        """Return event k as a (strip x sample) array, see remap."""
+        return remap(self.read_event(k))
+
+
+class WaveformTensor():
+    """
+    Class for a whole run as an (event x strip x sample) array.
+
+    Nothing is read until it's indexed, the data stays in the memory-mapped
+    wavecache.py files, so runs can be bigger than RAM. Strips are gathered
+    from the channels with STRIP_CHANNELS, one copy per read (not per event).
+
+    Example:
+        tensor = WaveformTensor("raw_waves_1500")
+        tensor[10]  # (strip x sample) array for event 10
+        tensor[:100, 3]  # (event x sample) array, strip 3
+        for start, batch in tensor.batches(1000):
+            ...
+    """
+
+    def __init__(self, directory, make_cache=True):
+        """
+        Open the wavecache.py caches of all the channels in directory.
+
+        make_cache: bool, convert wave<n>.txt files that have no cache yet
+                    (otherwise a missing cache is an error)
+        """
+        self.waves = []
+        for n in range(N_CHANNELS):
+            filename = os.path.join(directory, f"wave{n}.txt")
+            if not has_cache(filename):
+                if not make_cache:
+                    raise FileNotFoundError(f"no cache for {filename}")
+                convert(filename)
+            self.waves.append(WaveCache(filename).waves)
+        n_events = min(len(waves) for waves in self.waves)
+        self.shape = (n_events, len(STRIP_CHANNELS), self.waves[0].shape[1])
+
+    def __len__(self):
+        """Return the number of events."""
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        """Index like a numpy array with shape (event, strip, sample)."""
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3:
+            raise IndexError("too many indices for (event, strip, sample)")
+        events, strips, samples = key + (slice(None),)*(3 - len(key))
+        single_event = not isinstance(events, slice) and np.ndim(events) == 0
+        if isinstance(events, slice):
+            events = slice(*events.indices(len(self)))
+        elif single_event and not -len(self) <= events < len(self):
+            raise IndexError(f"event {events} out of range ({len(self)})")
+        channels = STRIP_CHANNELS[strips]
+        if np.ndim(channels) == 0:
+            return self.waves[channels][events, samples]
+        return np.stack([self.waves[channel][events, samples]
+                         for channel in channels],
+                        axis=0 if single_event else 1)
+
+    def batches(self, batch_size=1000):
+        """Yield (first event, event x strip x sample array) batches."""
+        for start in range(0, len(self), batch_size):
+            yield start, self[start:start + batch_size]
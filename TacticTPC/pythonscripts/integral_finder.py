@@ -0,0 +1,84 @@
+"""
+Find pulses in the wave<n>.txt files for many digitizer channels at once.
+
+This replaces integral_finder_1.py ... integral_finder_8.py, which were the
+same script with different channel numbers. Channels are spread over a pool
+of worker processes, so a full 32 channel run uses all the cores.
+
+Example:
+    python integral_finder.py -c 0 1 2 3 -j 4
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import sys
+import timeit
+
+# the pulse finding itself is in TacticTPC/waveforms.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from waveforms import CHUNK_SIZE, integrate_file
+
+ANALYSIS_DIR = "/home/grids/wavedump-3.8.2/Setup/analysis/"
+N_CHANNELS = 32  # digitizer channels 0-31
+
+
+def peak_info(n, analysis_dir=ANALYSIS_DIR, chunk_size=CHUNK_SIZE):
+    """
+    Find pulses for channel n (waven.txt -> channeln.txt).
+
+    Returns (n, number of records, time taken in seconds).
+    """
+    start = timeit.default_timer()
+    n_records = integrate_file(
+        os.path.join(analysis_dir, f"wave{n}.txt"),
+        os.path.join(analysis_dir, f"channel{n}.txt"),
+        chunk_size=chunk_size, verbose=False)
+    return n, n_records, timeit.default_timer() - start
+
+
+def run(channels, workers=None, analysis_dir=ANALYSIS_DIR,
+        chunk_size=CHUNK_SIZE):
+    """
+    Process the given channels in a pool of workers, print throughput.
+
+    channels: list of digitizer channel numbers
+    workers: number of processes, default = number of cores
+    Returns a dict of {channel: (number of records, seconds)}.
+    """
+    start = timeit.default_timer()
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(peak_info, n, analysis_dir, chunk_size)
+                   for n in channels]
+        for future in as_completed(futures):
+            n, n_records, seconds = future.result()
+            results[n] = (n_records, seconds)
+            # a tiny file can take "0 s" with a coarse timer
+            print(f"channel {n:2d}: {n_records} records in {seconds:.1f} s "
+                  f"({n_records / max(seconds, 1e-9):.0f} records/s)")
+    total_seconds = timeit.default_timer() - start
+    total_records = sum(n_records for n_records, _ in results.values())
+    print(f"total: {total_records} records from {len(results)} channels "
+          f"in {total_seconds:.1f} s "
+          f"({total_records / max(total_seconds, 1e-9):.0f} records/s)")
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "-c", dest="channels", nargs="+", type=int,
+        default=list(range(N_CHANNELS)), choices=range(N_CHANNELS),
+        metavar="N", help="digitizer channels to process (default: all)")
+    parser.add_argument(
+        "-j", dest="workers", type=int, default=None,
+        help="number of worker processes (default: number of cores)")
+    parser.add_argument(
+        "-d", dest="analysis_dir", default=ANALYSIS_DIR,
+        help="directory with the wave<n>.txt files")
+    parser.add_argument(
+        "--chunk-size", type=int, default=CHUNK_SIZE,
+        help="number of records to process at once")
+    args = parser.parse_args()
+    run(args.channels, workers=args.workers, analysis_dir=args.analysis_dir,
+        chunk_size=args.chunk_size)
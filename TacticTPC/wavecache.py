@@ -0,0 +1,170 @@
+"""
+Module for converting wave<n>.txt files into a binary cache.
+
+Parsing the text files is slow, so this converts each of them (once) into:
+- wave<n>.i16: all the ADC samples as raw int16, to be memory-mapped
+- wave<n>.idx.npz: record offsets into wave<n>.i16, a table of the
+  record headers (record_length, board_id, channel, event_number, ...),
+  and whether the text file ended in an incomplete record
+
+Record k is then samples[offsets[k]:offsets[k+1]], so there's no parsing
+and getting any record takes the same time.
+When a cache exists, waveforms.read_chunks (and so the peak finder) and
+the event display in tactic_ana.ipynb use it instead of the text file.
+
+Example:
+    python wavecache.py raw_waves_1500/wave*.txt
+"""
+from argparse import ArgumentParser
+import os
+import re
+import timeit
+import numpy as np
+
+from waveforms import (CHUNK_SIZE, RECORD_MARKER, ends_in_partial_record,
+                       parse_samples, read_records)
+
+SAMPLES_SUFFIX = ".i16"
+INDEX_SUFFIX = ".idx.npz"
+
+
+def cache_paths(wave_filename):
+    """Return (samples path, index path) of the cache for a wave file."""
+    base = os.path.splitext(wave_filename)[0]
+    return base + SAMPLES_SUFFIX, base + INDEX_SUFFIX
+
+
+def has_cache(wave_filename):
+    """
+    Return True if there's an up to date cache for a wave file.
+
+    (if the text file has been deleted to save space, the cache is used)
+    """
+    paths = cache_paths(wave_filename)
+    if not all(os.path.exists(path) for path in paths):
+        return False
+    with np.load(paths[1]) as index:
+        if "partial_end" not in index.files:
+            return False  # made before partial_end was saved
+    if not os.path.exists(wave_filename):
+        return True
+    cache_time = min(os.path.getmtime(path) for path in paths)
+    return cache_time >= os.path.getmtime(wave_filename)
+
+
+def _field_name(key):
+    """Turn a header key into a field name, 'BoardID' -> 'boardid'."""
+    return re.sub(r"[^a-z0-9]+", "_", key.lower()).strip("_")
+
+
+def _header_value(value):
+    """Return a header value as an int (they can be hex), -1 if it isn't."""
+    try:
+        return int(value, 0)
+    except ValueError:
+        return -1
+
+
+def parse_headers(records, header_lines):
+    """
+    Return (field names, rows of values) for the headers of some records.
+
+    records: list of record bytes, like those from waveforms.read_records
+    """
+    names = None
+    rows = []
+    for rec in records:
+        lines = (RECORD_MARKER + rec).split(b"\n", header_lines)[:-1]
+        keys, values = zip(*(line.partition(b":")[::2] for line in lines))
+        if names is None:
+            names = [_field_name(key.decode()) for key in keys]
+        rows.append(tuple(_header_value(value) for value in values))
+    return names, rows
+
+
+def convert(wave_filename, chunk_size=CHUNK_SIZE):
+    """Write the cache for a wave<n>.txt file, return number of records."""
+    samples_path, index_path = cache_paths(wave_filename)
+    names = []
+    rows = []
+    sizes = []
+    with open(samples_path, "wb") as samples_file:
+        for records, header_lines, samples in read_records(
+                wave_filename, chunk_size):
+            parse_samples(records, header_lines, samples).tofile(samples_file)
+            names, chunk_rows = parse_headers(records, header_lines)
+            rows += chunk_rows
+            sizes += [samples]*len(records)
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    headers = np.array(rows, dtype=[(name, np.int64) for name in names])
+    # the cache only has complete records, this says if one was left out
+    partial_end = ends_in_partial_record(wave_filename)
+    # written last, so a cache is only complete if this file exists
+    np.savez(index_path, offsets=offsets, headers=headers,
+             partial_end=partial_end)
+    return len(sizes)
+
+
+class WaveCache():
+    """Class for reading records from a converted wave<n>.txt file."""
+
+    def __init__(self, wave_filename):
+        """Open the cache of wave_filename (nothing is read yet)."""
+        samples_path, index_path = cache_paths(wave_filename)
+        with np.load(index_path) as index:
+            self.offsets = index["offsets"]
+            self.headers = index["headers"]
+            self.partial_end = bool(index["partial_end"])
+        if self.offsets[-1] > 0:
+            self.samples = np.memmap(samples_path, dtype=np.int16, mode="r")
+        else:
+            self.samples = np.zeros(0, dtype=np.int16)
+
+    def __len__(self):
+        """Return the number of records."""
+        return len(self.offsets) - 1
+
+    def __getitem__(self, k):
+        """Return the waveform of record k (a read-only view)."""
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError(f"record {k} out of range ({len(self)} records)")
+        return self.samples[self.offsets[k]:self.offsets[k+1]]
+
+    @property
+    def waves(self):
+        """All the waveforms as a (records x samples) memory-mapped array."""
+        lengths = np.diff(self.offsets)
+        if len(lengths) == 0:
+            return self.samples.reshape(0, 0)
+        if np.any(lengths != lengths[0]):
+            raise ValueError("records don't all have the same length")
+        return self.samples[:self.offsets[-1]].reshape(len(self), lengths[0])
+
+    def chunks(self, chunk_size=CHUNK_SIZE, skip_last=False):
+        """
+        Yield (records x samples) chunks, like waveforms.read_chunks.
+
+        skip_last: bool, leave out the last record of the text file, which
+                   is the last cached one only if the file didn't end in
+                   an incomplete record (those aren't cached)
+        """
+        waves = self.waves
+        skip = skip_last and not self.partial_end
+        stop = len(waves) - 1 if skip else len(waves)
+        for start in range(0, stop, chunk_size):
+            yield waves[start:min(start + chunk_size, stop)]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "files", nargs="+", help="wave<n>.txt files to convert")
+    args = parser.parse_args()
+    for wave_file_name in args.files:
+        start = timeit.default_timer()
+        n_records = convert(wave_file_name)
+        seconds = timeit.default_timer() - start
+        print(f"{wave_file_name}: {n_records} records in {seconds:.1f} s")
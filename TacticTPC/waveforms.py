@@ -0,0 +1,270 @@
+"""
+Module for finding pulses in the wave<n>.txt files written by wavedump.
+
+This finds the same pulses as the original per-channel python 2 scripts
+(integral_finder_1.py ... integral_finder_8.py, now replaced by
+pythonscripts/integral_finder.py), but instead of looping over samples in
+python, records are read in chunks and turned into 2D numpy arrays
+(records x samples), so the pedestal, amplitude, threshold time and
+integral are calculated for a whole chunk at once.
+
+Each record in a wave<n>.txt file looks like:
+
+    Record Length: 1030
+    BoardID: 31
+    ...
+    DC offset (DAC): 0x1999
+    3891
+    3890
+    ...
+
+i.e. a few header lines followed by one ADC sample per line.
+"""
+from dataclasses import dataclass
+import os
+import numpy as np
+
+CHUNK_SIZE = 1000  # number of records to process at once
+
+# these are the numbers used in the original integral_finder scripts
+PEDESTAL_SAMPLES = slice(1, 30)  # samples used to calculate the pedestal
+AMPLITUDE_CUT = 150  # pulses with amplitude <= this are written as "0 0"
+THRESHOLD_FRACTION = 0.15  # time = where the pulse crosses 15% amplitude
+INT_WINDOW = 400  # number of samples to integrate before the minimum
+
+RECORD_MARKER = b"Record"  # first word of every record header
+
+
+@dataclass
+class Pulses:
+    """Pulse properties for a chunk of records, one entry per record."""
+
+    pedestal: np.ndarray
+    amplitude: np.ndarray
+    time: np.ndarray  # -1 where no threshold crossing was found
+    integral: np.ndarray
+
+    @property
+    def passed(self):
+        """Mask of records with a big enough pulse."""
+        return self.amplitude > AMPLITUDE_CUT
+
+
+def _is_sample(line):
+    """Return True if the line holds an ADC sample (not a header line)."""
+    return line.strip().lstrip(b"-").isdigit()
+
+
+def record_layout(wave_file):
+    """
+    Return (header_lines, samples, record_bytes) for an open wave file.
+
+    Uses the first record in the file, record_bytes is its size in bytes.
+    wave_file: file opened in binary mode, is rewound afterwards
+    """
+    header_lines = 0
+    samples = 0
+    record_bytes = 0
+    for line in wave_file:
+        if _is_sample(line):
+            samples += 1
+        elif samples > 0:
+            break  # start of the second record
+        else:
+            header_lines += 1
+        record_bytes += len(line)
+    wave_file.seek(0)
+    return header_lines, samples, record_bytes
+
+
+def _is_complete(record, header_lines, samples):
+    """Return True if the bytes of a record have all its samples."""
+    return len(record.split(b"\n", header_lines)[-1].split()) == samples
+
+
+def ends_in_partial_record(filename):
+    """
+    Return True if a wave<n>.txt file ends in an incomplete record.
+
+    Only the end of the file is read (the last record can't be much
+    longer than the first one).
+    """
+    with open(filename, "rb") as wave_file:
+        header_lines, samples, record_bytes = record_layout(wave_file)
+        if samples == 0:
+            return False
+        wave_file.seek(0, os.SEEK_END)
+        wave_file.seek(max(wave_file.tell() - 2*record_bytes, 0))
+        tail = wave_file.read()
+    last = tail.rpartition(RECORD_MARKER)[2]
+    return not _is_complete(last, header_lines, samples)
+
+
+def parse_samples(records, header_lines, samples):
+    """
+    Return an int16 array (records x samples) from a list of records,
+    each being the bytes of one record after the word "Record".
+    """
+    sample_blocks = [rec.split(b"\n", header_lines)[-1] for rec in records]
+    waves = np.fromstring(b"".join(sample_blocks), dtype=np.int16, sep=" ")
+    if waves.size != len(records)*samples:
+        raise ValueError(f"records don't all have {samples} samples")
+    return waves.reshape(len(records), samples)
+
+
+def read_records(filename, chunk_size=CHUNK_SIZE, skip_last=False):
+    """
+    Yield (records, header_lines, samples) for chunks of a wave<n>.txt file.
+
+    records is a list with the bytes of about chunk_size complete records
+    (everything after the word "Record"), to be parsed by parse_samples.
+    An incomplete record at the end of the file is ignored.
+
+    skip_last: bool, if True the last record in the file is never returned,
+               whether it's complete or not (like the original scripts)
+    """
+    with open(filename, "rb") as wave_file:
+        header_lines, samples, record_bytes = record_layout(wave_file)
+        if samples == 0:
+            return
+        leftover = b""
+        while True:
+            block = wave_file.read(chunk_size*record_bytes)
+            # the first element is everything before the first "Record"
+            records = (leftover + block).split(RECORD_MARKER)[1:]
+            if not records:
+                return
+            # the last record may continue in the next block
+            leftover = RECORD_MARKER + records.pop()
+            if not block and not skip_last:
+                last = leftover[len(RECORD_MARKER):]
+                if _is_complete(last, header_lines, samples):
+                    records.append(last)
+            if records:
+                yield records, header_lines, samples
+            if not block:
+                return
+
+
+def read_chunks(filename, chunk_size=CHUNK_SIZE, skip_last=False):
+    """
+    Yield chunks of waveforms from a wave<n>.txt file.
+
+    Each chunk is an int16 array with shape (records, samples),
+    with about chunk_size records. An incomplete record at the end of
+    the file (e.g. if wavedump is still writing) is ignored.
+    If the file has been converted with wavecache.py, the cache is used.
+
+    skip_last: bool, if True the last record in the file is never returned,
+               whether it's complete or not (like the original scripts)
+    """
+    # imported here since wavecache uses the parsing functions above
+    from wavecache import WaveCache, has_cache
+    if has_cache(filename):
+        yield from WaveCache(filename).chunks(chunk_size, skip_last)
+        return
+    for records, header_lines, samples in read_records(
+            filename, chunk_size, skip_last):
+        try:
+            yield parse_samples(records, header_lines, samples)
+        except ValueError as err:
+            raise ValueError(f"{filename}: {err}") from err
+
+
+def analyse(waves):
+    """
+    Calculate pulse properties for a (records x samples) array of waveforms.
+
+    Pulses are negative, so the amplitude is pedestal - minimum.
+    The time is the last sample before the minimum (looking back at most
+    INT_WINDOW samples) that is above pedestal - 15% of the amplitude.
+    The integral is the sum of pedestal - sample from INT_WINDOW samples
+    before the minimum up to the minimum, plus from the minimum to the end
+    of the record.
+
+    (The forward half of the original integral loop checks `i` instead of
+    `j`, so it never stops at INT_WINDOW, and the minimum is counted twice.
+    We do the same thing here so the output doesn't change.)
+    """
+    n_records, n_samples = waves.shape
+    pedestal = waves[:, PEDESTAL_SAMPLES].sum(axis=1, dtype=np.int64) / 29.
+    min_index = np.argmin(waves, axis=1)
+    minimum = waves[np.arange(n_records), min_index]
+    amplitude = pedestal - minimum
+
+    # look backwards from the minimum for the threshold crossing
+    threshold = pedestal - THRESHOLD_FRACTION * amplitude
+    steps_back = np.arange(INT_WINDOW + 1)
+    window = min_index[:, None] - steps_back[None, :]
+    in_record = window >= 0
+    window_vals = np.take_along_axis(waves, np.where(in_record, window, 0), 1)
+    above = in_record & (window_vals > threshold[:, None])
+    time = np.where(above.any(axis=1),
+                    min_index - np.argmax(above, axis=1), -1)
+
+    # integrate, adding up terms in the same order as the original loops
+    # (cumsum adds sequentially, so we get the same rounding, and the
+    # zeros used for padding don't change the sum)
+    forward = min_index[:, None] + np.arange(n_samples)[None, :]
+    in_record_fwd = forward < n_samples
+    forward_vals = np.take_along_axis(
+        waves, np.where(in_record_fwd, forward, 0), 1)
+    terms = np.concatenate([
+        np.where(in_record, pedestal[:, None] - window_vals, 0.),
+        np.where(in_record_fwd, pedestal[:, None] - forward_vals, 0.),
+        ], axis=1)
+    integral = np.cumsum(terms, axis=1)[:, -1]
+
+    return Pulses(pedestal, amplitude, time, integral)
+
+
+def _py2_str(number):
+    """Format a float the way python 2's str() does, e.g. 66189.2068966."""
+    text = f"{number:.12g}"
+    if not any(c in text for c in ".ein"):
+        text += ".0"
+    return text
+
+
+def integrate_file(wave_filename, channel_filename, chunk_size=CHUNK_SIZE,
+                   verbose=True):
+    """
+    Find pulses in wave_filename, write `time int_sum` lines to
+    channel_filename, and return the number of records written.
+
+    verbose: bool, print progress after every chunk
+
+    The output is the same as the original python 2 scripts wrote, one
+    line per record (event), "<time> <integral>":
+    - time is an int (sample number), the integral is written like
+      python 2's str(float), i.e. "%.12g" with ".0" added to whole
+      numbers (see _py2_str)
+    - records without a pulse are written as "0 0"
+    - if no threshold crossing is found, the previous time is reused
+    - the last record in the file is skipped (the original only processed
+      a record when it saw the "Record" line of the next one)
+    """
+    last_time = 0
+    n_written = 0
+    with open(channel_filename, "w", encoding="utf-8") as channel_file:
+        for waves in read_chunks(wave_filename, chunk_size=chunk_size,
+                                 skip_last=True):
+            pulses = analyse(waves)
+            passed = pulses.passed
+
+            # reuse the previous time where none was found
+            found = passed & (pulses.time >= 0)
+            last_found = np.where(found, np.arange(len(found)), -1)
+            np.maximum.accumulate(last_found, out=last_found)
+            time = np.where(last_found >= 0,
+                            pulses.time[last_found], last_time)
+            if found.any():
+                last_time = time[found][-1]
+
+            channel_file.writelines(
+                f"{t} {_py2_str(int_sum)}\n" if p else "0 0\n"
+                for t, int_sum, p in zip(time, pulses.integral, passed))
+            n_written += len(waves)
+            if verbose:
+                print(f"Processed {n_written} events from {wave_filename}")
+    return n_written